@@ -2,16 +2,34 @@
 Common assembler/disassembler routines.
 This module is meant to be imported.
 """
+import functools
 import re
 
-comma_replace     = '@@@z@@Q@@@'
-quote_replace     = '$$$q$$H$$$'
-backslash_replace = '###g##V###'
+# kinds of the argument tokens produced by parse_lines()
+TOKEN_INT, TOKEN_HEX, TOKEN_SYMBOL, TOKEN_STRING, TOKEN_MSGID = range(5)
 
-re_label = re.compile(r'([A-Za-z_][A-Za-z0-9_]+):$')
-re_instr = re.compile(r'([A-Za-z_][A-Za-z0-9_:]*)\((.*)\);$')
-re_header = re.compile(r'#header\s+"(.+)"')
-re_define = re.compile(r'#define\s+([A-Za-z0-9_]+)\s+([A-Za-z0-9_]+)')
+# kinds of the lines produced by parse_lines()
+LINE_INSTR, LINE_LABEL, LINE_DIRECTIVE = range(3)
+
+# a whole .bsd line: instruction, label or directive, then an optional comment
+re_line = re.compile(r'''[ \t\r\f\v]*(?:
+    (?P<fcn>[A-Za-z_][A-Za-z0-9_]*(?:::[A-Za-z0-9_]+)*)[ \t]*
+      \((?P<args>(?:[^"()\n/]+|/(?!/)|"(?:[^"\\\n]+|\\.)*")*)\)[ \t]*;
+  | (?P<label>[A-Za-z_][A-Za-z0-9_]*)[ \t]*:
+  | \#(?P<directive>[a-z]+)(?P<operands>(?:[^"\n/]+|/(?!/)|"(?:[^"\\\n]+|\\.)*")*)
+)?[ \t\r\f\v]*(?://[^\n]*)?(?:\n|\Z)''', re.VERBOSE)
+
+# an argument (or directive operand) and its separator
+re_arg = re.compile(r'[ \t\r\f\v]*(?:"((?:[^"\\\n]+|\\.)*)"|([^\s",]+))[ \t\r\f\v]*(,?)')
+
+WORDS_CACHE_SIZE = 4096
+
+re_escape_sequence = re.compile(r'\\([\\abtnvfr"])')
+
+_escapes = str.maketrans({'\\': '\\\\', '\a': '\\a', '\b': '\\b', '\t': '\\t', '\n': '\\n',
+                          '\v': '\\v', '\f': '\\f', '\r': '\\r', '"': '\\"'})
+_unescapes = {'\\': '\\', 'a': '\a', 'b': '\b', 't': '\t', 'n': '\n', 'v': '\v', 'f': '\f',
+              'r': '\r', '"': '"'}
 
 
 class QuoteMismatch(Exception):
@@ -35,88 +53,141 @@ class InvalidFunction(Exception):
     pass
 
 
+class InvalidBytecode(Exception):
+    """
+    Raised when bytecode cannot be decoded
+    """
+    pass
+
+
+class UnknownOpcode(InvalidBytecode):
+    """
+    Raised when bytecode contains an opcode whose size is unknown
+    """
+    pass
+
+
 def escape(text):
     """
     Escape text when writing to file
     Returns: str
     """
-    text = text.replace('\\', '\\\\')
-    text = text.replace('\a', '\\a')
-    text = text.replace('\b', '\\b')
-    text = text.replace('\t', '\\t')
-    text = text.replace('\n', '\\n')
-    text = text.replace('\v', '\\v')
-    text = text.replace('\f', '\\f')
-    text = text.replace('\r', '\\r')
-    text = text.replace('"', '\\"')
-    return text
+    return text.translate(_escapes)
+
+
+def _unescape_match(match):
+    return _unescapes[match.group(1)]
 
 
 def unescape(text):
     """
-    Reverse operation of escape()
+    Reverse operation of escape(), in a single pass
+    (backslashes not starting an escape sequence are kept as-is)
     Returns: str
     """
-    text = text.replace('\\\\', backslash_replace)
-    text = text.replace('\\a', '\a')
-    text = text.replace('\\b', '\b')
-    text = text.replace('\\t', '\t')
-    text = text.replace('\\n', '\n')
-    text = text.replace('\\v', '\v')
-    text = text.replace('\\f', '\f')
-    text = text.replace('\\r', '\r')
-    text = text.replace('\\"', '"')
-    text = text.replace(backslash_replace, '\\')
-    return text
+    if '\\' not in text:
+        return text
+    return re_escape_sequence.sub(_unescape_match, text)
 
 
-def remove_comment(line):
+def get_word_token(word):
     """
-    Strips any trailing whitespace and comments
-    Returns: str
+    Type an unquoted argument: MSGID::0012, hexadecimal or decimal integer, or symbol
+    Returns: tuple (kind:int, value) (ValueError on invalid numbers)
     """
-    cpos = 0
-    while True:
-        cpos = line.find('//', cpos)
-        if cpos == -1:
-            return line.rstrip()
-        qcount = line[:cpos].count('"') - line[:cpos].count('\\"')
-        if qcount % 2 == 0:
-            break
-        cpos += 1
-    line = line[:cpos]
-    return line.rstrip()
+    if word.startswith('MSGID::'):
+        return TOKEN_MSGID, word[7:]
+    if word[0].isdigit() or word[0] == '-':
+        if word.startswith('0x') or word.startswith('-0x'):
+            return TOKEN_HEX, int(word, 16)
+        return TOKEN_INT, int(word)
+    return TOKEN_SYMBOL, word
 
 
-def get_quotes(line):
+def get_raw_word_token(word):
     """
-    Finds all occurrences of quote character
-    Returns: array of integers
+    Keep an unquoted directive operand as written
+    Returns: tuple (TOKEN_SYMBOL, str)
     """
+    return TOKEN_SYMBOL, word
+
+
+@functools.lru_cache(maxsize=WORDS_CACHE_SIZE)
+def _parse_words(argstr, separator, get_token):
+    if not argstr.strip():
+        return ()
+    words = [word.strip() for word in (argstr.split(separator) if separator else argstr.split())]
+    if not all(words):
+        raise ValueError('missing argument')
+    return tuple(get_token(word) for word in words)
+
+
+def _parse_quoted_args(argstr, separator, get_token):
+    args = []
     pos = 0
-    quotes = []
-    while True:
-        pos = line.find('"', pos)
-        if pos == -1:
-            break
-        quotes.append(pos)
-        pos += 1
-    return quotes
+    sep = ''
+    while pos < len(argstr):
+        match = re_arg.match(argstr, pos)
+        if match is None or match.end() == pos:
+            raise ValueError('invalid argument')
+        string, word, sep = match.groups()
+        if sep != separator and (sep or match.end() < len(argstr)):
+            raise ValueError('invalid separator')
+        if string is not None:
+            args.append((TOKEN_STRING, unescape(string)))
+        else:
+            args.append(get_token(word))
+        pos = match.end()
+    if sep:
+        raise ValueError('missing argument')
+    return args
+
+
+def parse_args(argstr, linenum, separator=',', get_token=get_word_token):
+    """
+    Split the arguments of an instruction (or the operands of a directive, separated by
+    whitespace when `separator` is empty) into tokens, unescaping strings
+    Unquoted words are typed by `get_token` (see get_word_token(), get_raw_word_token()).
+    Argument lists without strings are memoized, most being repeated throughout scripts.
+    Returns: sequence of tuple (kind:int, value)
+    """
+    try:
+        if '"' not in argstr:
+            return _parse_words(argstr, separator, get_token)
+        return _parse_quoted_args(argstr, separator, get_token)
+    except ValueError as exc:
+        raise InvalidInstructionFormat('Invalid arguments ({}) @ line {:d}'.format(exc, linenum))
 
 
-def replace_quote_commas(line, quotes):
+def parse_lines(text):
+    """
+    Split .bsd text into its lines of code, in a single pass (one match per line)
+    Comments and blank lines are skipped.
+    Yields: tuple (line number:int, kind:int, name:str, list of argument tokens)
+    - LINE_INSTR: function name and its arguments (see parse_args())
+    - LINE_LABEL: label name, no arguments
+    - LINE_DIRECTIVE: directive name (e.g. 'define'), and its operands, unquoted ones
+      being kept as written (see get_raw_word_token())
+    """
+    linenum = 0
     pos = 0
-    commas = []
-    while True:
-        pos = line.find(',', pos)
-        if pos == -1:
-            break
-        for squote, equote in zip(quotes[::2], quotes[1::2]):
-            if squote < pos < equote:
-                commas.append(pos)
-                break
-        pos += 1
-    commas.reverse()
-    for pos in commas:
-        line = line[:pos] + comma_replace + line[pos + 1:]
-    return line
+    for match in re_line.finditer(text):
+        if match.start() != pos:
+            # the line at `pos` did not match, the search skipped it
+            line = text[pos:].split('\n', 1)[0]
+            if (line.count('"') - line.count('\\"')) % 2:
+                raise QuoteMismatch('Mismatched quotes @ line %d' % (linenum + 1))
+            raise InvalidInstructionFormat(
+                'Invalid instruction format @ line {:d}'.format(linenum + 1))
+        if pos == len(text):
+            break  # empty match after the last newline
+        linenum += 1
+        pos = match.end()
+        fcn, argstr, label, directive, operands = match.groups()
+        if fcn is not None:
+            yield linenum, LINE_INSTR, fcn, parse_args(argstr, linenum)
+        elif label is not None:
+            yield linenum, LINE_LABEL, label, []
+        elif directive is not None:
+            yield linenum, LINE_DIRECTIVE, directive, parse_args(operands, linenum, '',
+                                                                 get_raw_word_token)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Reads and repacks BGI archives (.arc) without extracting them
+
+Supported indexes:
+  "PackFile    " with 32-byte entries (16-byte names)
+  "BURIKO ARC20" with 128-byte entries (96-byte names)
+Members are exposed as-is, as zero-copy memoryviews over a read-only mmap of the archive.
+
+Usage:
+  with bgi_arc.ArcFile('data010.arc') as arc:
+      for name in arc.namelist():
+          data = arc.read(name)
+"""
+import fnmatch
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+import bgi_common
+import bgi_log
+import bgi_setup
+import buriko_setup
+
+
+# magic: (entry size, name size)
+ARC_FORMATS = {
+    b'PackFile    ': (0x20, 0x10),
+    b'BURIKO ARC20': (0x80, 0x60),
+}
+
+COPY_CHUNK_SIZE = 1 << 20
+
+
+class ArcFile:
+    """
+    Read-only, memory-mapped BGI archive
+    Member views must be released before calling close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.magic = None
+        self.members = {}
+        self.entries = {}
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._file.close()
+            raise bgi_common.BgiCustomException('{}: not a BGI archive'.format(path))
+        self._view = memoryview(self._map)
+        try:
+            self._read_index()
+        except BaseException:
+            self.close()
+            raise
+
+    def _read_index(self):
+        magic = self._map[:12]
+        if magic not in ARC_FORMATS:
+            raise bgi_common.BgiCustomException('{}: not a BGI archive'.format(self.path))
+        self.magic = magic
+        entry_size, name_size = ARC_FORMATS[magic]
+        count, = struct.unpack('<I', self._map[12:16])
+        data_pos = 16 + count * entry_size
+        if data_pos > len(self._map):
+            raise bgi_common.BgiCustomException('{}: truncated index'.format(self.path))
+        for idx in range(count):
+            pos = 16 + idx * entry_size
+            name = self._map[pos:pos + name_size].split(b'\x00', 1)[0]
+            offset, size = struct.unpack('<II', self._map[pos + name_size:pos + name_size + 8])
+            start = data_pos + offset
+            if start + size > len(self._map):
+                raise bgi_common.BgiCustomException(
+                    '{}: member {} is out of bounds'.format(self.path, name))
+            try:
+                name = name.decode(bgi_setup.senc)
+            except UnicodeDecodeError:
+                raise bgi_common.BgiCustomException(
+                    '{}: member name {!r} cannot be decoded'.format(self.path, name))
+            self.members[name] = (start, size)
+            self.entries[name] = self._map[pos:pos + entry_size]
+
+    def namelist(self):
+        """
+        Returns: array of member names, in archive order
+        """
+        return list(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def fileno(self):
+        """
+        Returns: file descriptor of the archive, for byte-range copies
+        """
+        return self._file.fileno()
+
+    def get_range(self, name):
+        """
+        Returns: tuple (absolute offset in archive, size) of a member
+        """
+        return self.members[name]
+
+    def read(self, name):
+        """
+        Zero-copy access to the contents of a member
+        Returns: memoryview
+        """
+        start, size = self.members[name]
+        return self._view[start:start + size]
+
+    def close(self):
+        """
+        Unmap and close the archive
+        """
+        if self._file.closed:
+            return
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # member views still exported, unmapped once they are released
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def is_safe_name(name):
+    """
+    Check that a member name designates a file of the output folder itself
+    (no path separator nor drive, no '..', not absolute)
+    Returns: Boolean
+    """
+    return (name not in ('', '.', '..') and not any(sep in name for sep in '/\\:') and
+            os.path.basename(name) == name and not os.path.isabs(name))
+
+
+def extract(arcpath, outdir='.', pattern='*'):
+    """
+    Write members matching `pattern` to `outdir`, named as in the archive (no extension added)
+    Member names that would write outside `outdir` raise BgiCustomException.
+    """
+    bgi_common.makedir(outdir)
+    with ArcFile(arcpath) as arc:
+        for name in arc.namelist():
+            if fnmatch.fnmatch(name, pattern):
+                if not is_safe_name(name):
+                    raise bgi_common.BgiCustomException(
+                        '{}: unsafe member name {!r}'.format(arcpath, name))
+                with open(os.path.join(outdir, name), 'wb') as outfile:
+                    outfile.write(arc.read(name))
+
+
+def copy_range(src_fd, dst_fd, offset, size):
+    """
+    Append `size` bytes read at `offset` of `src_fd` to `dst_fd`,
+    in kernel space when the platform allows it (copy_file_range, sendfile)
+    """
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while size > 0:
+                if method == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, size, offset)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, size)
+                if copied == 0:
+                    raise bgi_common.BgiCustomException('unexpected end of archive')
+                offset += copied
+                size -= copied
+            return
+        except OSError:
+            continue  # unsupported for these files, try the next method
+    while size > 0:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        chunk = os.read(src_fd, min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise bgi_common.BgiCustomException('unexpected end of archive')
+        os.write(dst_fd, chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+
+
+def repack(arcpath, outpath, replacements):
+    """
+    Write a copy of archive `arcpath` to `outpath`, replacing members by name
+    `replacements` is a dict {member name: path of a file, or bytes-like contents}.
+    Names missing from the archive are appended. Unchanged members are copied
+    as byte ranges, never loaded in Python. `outpath` is replaced atomically.
+    Returns: tuple (number of replaced members, number of appended members)
+    """
+    def get_size(value):
+        return os.path.getsize(value) if isinstance(value, str) else len(value)
+
+    with ArcFile(arcpath) as arc:
+        entry_size, name_size = ARC_FORMATS[arc.magic]
+        names = arc.namelist() + sorted(name for name in replacements if name not in arc)
+        index = bytearray()
+        offset = 0
+        for name in names:
+            if name in replacements:
+                size = get_size(replacements[name])
+            else:
+                size = arc.get_range(name)[1]
+            if name in arc:
+                entry = bytearray(arc.entries[name])
+            else:
+                binname = name.encode(bgi_setup.senc)
+                if len(binname) >= name_size:
+                    raise bgi_common.BgiCustomException(
+                        'member name too long for this archive: {}'.format(name))
+                entry = bytearray(binname.ljust(entry_size, b'\x00'))
+            struct.pack_into('<II', entry, name_size, offset, size)
+            index += entry
+            offset += size
+
+        tmppath = outpath + '.tmp'
+        try:
+            with open(tmppath, 'wb') as outfile:
+                outfile.write(arc.magic + struct.pack('<I', len(names)) + index)
+                outfile.flush()
+                for name in names:
+                    value = replacements.get(name)
+                    if value is None:
+                        start, size = arc.get_range(name)
+                        copy_range(arc.fileno(), outfile.fileno(), start, size)
+                    elif isinstance(value, str):
+                        with open(value, 'rb') as infile:
+                            shutil.copyfileobj(infile, outfile, COPY_CHUNK_SIZE)
+                        outfile.flush()
+                    else:
+                        outfile.write(value)
+                        outfile.flush()
+                outfile.flush()
+                if os.fstat(outfile.fileno()).st_size != len(arc.magic) + 4 + len(index) + offset:
+                    raise bgi_common.BgiCustomException(
+                        '{}: a replacement changed size while repacking'.format(outpath))
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+    os.replace(tmppath, outpath)
+    replaced = sum(1 for name in replacements if name in arc.members)
+    return replaced, len(replacements) - replaced
+
+
+def get_compiled(compiled_dir):
+    """
+    List the scripts of a bgias output folder
+    Returns: dict {member name: path}
+    """
+    compiled = {}
+    for name in sorted(os.listdir(compiled_dir)):
+        path = os.path.join(compiled_dir, name)
+        if not name.startswith('.') and os.path.isfile(path):
+            compiled[name] = path
+    return compiled
+
+
+def process(stage, arcpath, pattern='*'):
+    """
+    Run a tool straight on the members matching `pattern`, without extracting them
+    `stage` is 'dump' (bgi_dumppo) or 'dis' (bgidis)
+    Diagnostic files of 'dump' are written besides the archive.
+    Member names that would write outside its folder raise BgiCustomException.
+    """
+    import bgi_dumppo
+    import bgidis
+    tool = {'dump': bgi_dumppo.dump_script, 'dis': bgidis.dis}[stage]
+    basedir = os.path.dirname(arcpath)
+    with ArcFile(arcpath) as arc:
+        for name in arc.namelist():
+            if fnmatch.fnmatch(name, pattern):
+                if not is_safe_name(name):
+                    raise bgi_common.BgiCustomException(
+                        '{}: unsafe member name {!r}'.format(arcpath, name))
+                tool(os.path.join(basedir, name), arc.read(name))
+
+
+if __name__ == '__main__':
+    args = bgi_log.parse_args(sys.argv[1:])
+    if len(args) < 2 or args[0] not in ('list', 'extract', 'dump', 'dis', 'repack') or \
+            (args[0] == 'repack' and len(args) < 3):
+        print('Usage: bgi_arc.py list <archive>')
+        print('       bgi_arc.py extract <archive> [<output dir>] [<pattern>]')
+        print('       bgi_arc.py dump|dis <archive> [<pattern>]')
+        print('       bgi_arc.py repack <archive> <output archive> [<compiled dir>]')
+        print(bgi_log.USAGE)
+        sys.exit(1)
+    command, archive = args[0:2]
+    if command == 'list':
+        with ArcFile(archive) as arcfile:
+            for member in arcfile.namelist():
+                print('{:<32} {:>10d}'.format(member, arcfile.get_range(member)[1]))
+    elif command == 'extract':
+        extract(archive, *args[2:4])
+    elif command == 'repack':
+        compiled_dir = args[3] if len(args) > 3 else \
+            '{}/compiled'.format(buriko_setup.project_name)
+        with bgi_log.timed('repack', file=archive, output=args[2]) as event:
+            event['replaced'], event['appended'] = repack(archive, args[2],
+                                                          get_compiled(compiled_dir))
+        bgi_log.get_logger('arc').info('%d members replaced, %d appended',
+                                       event['replaced'], event['appended'])
+    else:
+        process(command, archive, *args[2:3])
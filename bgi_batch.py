@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Runs a BGI tool stage over a whole directory, in a single process pool
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import bgi_dumppo
+import bgi_log
+import bgi_reinsert
+import bgias
+import bgidis
+import buriko_setup
+
+log = bgi_log.get_logger('batch')
+
+
+STAGES = {
+    'dump': bgi_dumppo.dump_script,
+    'dis': bgidis.dis,
+    'as': bgias.asm,
+    'reinsert': bgi_reinsert.reinsert_script,
+}
+
+
+def get_inputs(stage, directory, pattern):
+    """
+    List the files of `directory` processed by `stage`:
+    .bsd and .bsb files for 'as' (one per script, see bgias.select_inputs()),
+    extension-less files otherwise
+    Returns: array of str
+    """
+    inputs = []
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        _, ext = os.path.splitext(path)
+        if not os.path.isfile(path):
+            continue
+        if (ext in ('.bsd', '.bsb')) if stage == 'as' else not ext:
+            inputs.append(path)
+    if stage == 'as':
+        inputs = bgias.select_inputs(inputs)
+    return inputs
+
+
+def run_one(task):
+    """
+    (Worker) Run a stage on a single file
+    Returns: tuple (str path, float seconds, str error or None, bool skipped)
+    """
+    stage, path = task
+    start = time.perf_counter()
+    error = None
+    skipped = False
+    try:
+        skipped = STAGES[stage](path) is False
+    except SystemExit as exc:
+        error = 'exited with status {}'.format(exc.code)
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+    return path, time.perf_counter() - start, error, skipped
+
+
+def run(stage, inputs, jobs):
+    """
+    Process `inputs` across `jobs` worker processes, logging progress
+    Emits a 'batch' event once all files are processed
+    Returns: list of failed paths
+    """
+    failed = []
+    skipped_count = 0
+    tasks = [(stage, path) for path in inputs]
+    with bgi_log.timed('batch', stage=stage, jobs=jobs) as event:
+        with multiprocessing.Pool(jobs, bgi_log.setup, bgi_log.get_settings()) as pool:
+            for done, (path, elapsed, error, skipped) in enumerate(
+                    pool.imap_unordered(run_one, tasks), 1):
+                status = 'FAILED' if error else 'up to date' if skipped else 'ok'
+                log.info('[%d/%d] %s %s (%.2f s)', done, len(tasks), status, path, elapsed)
+                if error:
+                    log.error('%s', error)
+                    failed.append(path)
+                skipped_count += skipped
+        event.update(files=len(tasks), failed=len(failed), skipped=skipped_count)
+    log.info('%s: %d file(s) processed, %d failed in %.2f s',
+             stage, len(tasks), len(failed), event['seconds'])
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Run dump (bgi_dumppo), dis (bgidis), as (bgias) '
+                    'or reinsert (bgi_reinsert) over a directory.')
+    parser.add_argument('stage', choices=sorted(STAGES))
+    parser.add_argument('directory', nargs='?',
+                        help="input directory (default: '.' for dump/dis/reinsert, "
+                             "the project folder for as)")
+    parser.add_argument('-p', '--pattern', default='*',
+                        help="file name glob within the directory (default: '*')")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: CPU count)')
+    bgi_log.add_arguments(parser)
+    args = parser.parse_args(argv)
+    bgi_log.configure(args)
+    directory = args.directory
+    if directory is None:
+        directory = buriko_setup.project_name if args.stage == 'as' else '.'
+    inputs = get_inputs(args.stage, directory, args.pattern)
+    failed = run(args.stage, inputs, max(1, args.jobs))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Benchmarks BGI script tools against a corpus of compiled scripts
+
+Each script goes through the stages of the dump/dis/as pipeline, each stage being timed
+separately (best of --repeat runs). Results are summed per stage into throughput figures
+(MB/s of script bytes, instructions/s), along with the peak RSS of the process, and may be
+saved as JSON then compared against in later runs to catch performance regressions.
+Scripts using opcodes unknown to bgiop go through the dump stages (their strings being
+found by scanning the code, as bgi_dumppo does), but not through dis/as.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import asdis
+import bgi_bsb
+import bgi_common
+import bgi_dumppo
+import bgi_po
+import bgias
+import bgidis
+import bgiop
+import buriko_common
+
+
+BENCH_FORMAT = 2
+
+DEFAULT_CORPUS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), folder, '*')
+                  for folder in ('input', 'input_aiyoku')]
+
+STAGES = ('split_data', 'text_table', 'decode', 'get_code_section', 'bgidis.parse',
+          'bgidis.out', 'make_po', 'po_save', 'po_load_cold', 'po_load', 'bgias.parse',
+          'bgias.assemble', 'bsb.from_instrs', 'bsb.assemble')
+
+# stages whose throughput is also reported in instructions/s
+INSTRUCTION_STAGES = ('decode', 'bgidis.parse', 'bgidis.out', 'bgias.parse', 'bgias.assemble',
+                      'bsb.from_instrs', 'bsb.assemble')
+
+
+def get_corpus(patterns):
+    """
+    Expand glob patterns into a sorted list of script paths
+    (only extension-less files are kept)
+    Returns: array of str
+    """
+    scripts = set()
+    for pattern in patterns:
+        for script in glob.glob(pattern):
+            _, ext = os.path.splitext(script)
+            if not ext and os.path.isfile(script):
+                scripts.add(script)
+    return sorted(scripts)
+
+
+def get_peak_rss():
+    """
+    Returns: int peak resident set size of the process in KiB, or None if unavailable
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS
+
+
+class StageTimer:
+    """
+    Best time of each stage over repeated runs of a script
+    """
+
+    def __init__(self):
+        self.times = {}
+
+    def run(self, stage, fcn, *args):
+        """
+        Time fcn(*args) as `stage`
+        Returns: result of fcn
+        """
+        start = time.perf_counter()
+        result = fcn(*args)
+        elapsed = time.perf_counter() - start
+        self.times[stage] = min(elapsed, self.times.get(stage, elapsed))
+        return result
+
+
+def bench_script(data, workdir, repeat=1):
+    """
+    Run all stages on a script buffer, PO files being written to `workdir`
+    Returns: tuple (dict {stage: float seconds}, int instructions, str or None error)
+    `error` tells why the stages after it were not run.
+    """
+    timer = StageTimer()
+    instructions = 0
+    popath = os.path.join(workdir, 'bench.po')
+    for _ in range(repeat):
+        hdr_bytes, code_bytes, text_bytes, config = timer.run(
+            'split_data', bgi_common.split_data, data, True)
+        # strings are looked up through a TextTable, never decoded upfront, as the tools do
+        timer.run('text_table', bgi_common.TextTable, text_bytes)
+        code = memoryview(data)[len(hdr_bytes):]
+        error = None
+        try:
+            instrs = timer.run('decode', bgiop.decode, code, len(code_bytes))
+            instructions = len(instrs)
+        except asdis.InvalidBytecode as exc:
+            # bgi_dumppo still scans the code for strings, bgidis cannot go further
+            instrs = None
+            error = str(exc)
+        state = bgi_common.CodeSectionState()
+        code_section, _ = timer.run('get_code_section', state.get_code_section,
+                                    code_bytes, text_bytes, config, instrs)
+        writer = bgi_po.PoWriter()
+        timer.run('make_po', bgi_dumppo.register_translations, writer, code_section)
+        timer.run('po_save', writer.save, popath)
+        # POs are loaded as the tools do: parsed by polib once the PO changed (the sidecar
+        # being written on the way), then served by the sidecar while it stays unchanged
+        cachepath = popath + bgi_po.CATALOG_CACHE_EXT
+        if os.path.exists(cachepath):
+            os.remove(cachepath)
+        timer.run('po_load_cold', bgi_po.load_catalog, popath)
+        catalog = timer.run('po_load', bgi_po.load_catalog, popath)
+        if error is not None:
+            return timer.times, instructions, error
+
+        try:
+            parsed = timer.run('bgidis.parse', bgidis.parse, code, bytes(hdr_bytes), instrs)
+        except struct.error:  # header layout unknown to bgidis.parse_hdr()
+            return timer.times, instructions, 'unsupported header'
+        bsd = io.StringIO()
+        timer.run('bgidis.out', bgidis.out, bsd, *parsed)
+
+        asmparsed = timer.run('bgias.parse', bgias.parse_bsd, bsd.getvalue())
+        timer.run('bgias.assemble', bgias.assemble, asmparsed, catalog)
+
+        bsb = timer.run('bsb.from_instrs', bgi_bsb.from_instrs, *parsed)
+        timer.run('bsb.assemble', lambda: bytes(bgias.build(*bgias.link_bsb(bgi_bsb.Bsb(bsb),
+                                                                             catalog))))
+    return timer.times, instructions, None
+
+
+def summarize(results):
+    """
+    Sum per-script results into per-stage totals and throughput
+    Returns: dict {stage: dict}
+    """
+    stages = {}
+    for stage in STAGES:
+        seconds = 0.0
+        files = 0
+        size = 0
+        instructions = 0
+        for result in results.values():
+            if stage in result['stages']:
+                seconds += result['stages'][stage]
+                files += 1
+                size += result['bytes']
+                instructions += result['instructions']
+        if not files:
+            continue
+        summary = {'files': files, 'bytes': size, 'seconds': seconds,
+                   'mb_per_s': size / seconds / 1e6 if seconds else None}
+        if stage in INSTRUCTION_STAGES:
+            summary['instructions'] = instructions
+            summary['instructions_per_s'] = instructions / seconds if seconds else None
+        stages[stage] = summary
+    return stages
+
+
+def print_summary(report):
+    """
+    Print the per-stage totals of a report
+    """
+    print('{:<18} {:>6} {:>10} {:>10} {:>14}'.format(
+        'stage', 'files', 'seconds', 'MB/s', 'instructions/s'))
+    for stage, summary in report['stages'].items():
+        print('{:<18} {:>6d} {:>10.3f} {:>10.2f} {:>14}'.format(
+            stage, summary['files'], summary['seconds'], summary['mb_per_s'] or 0,
+            '{:.0f}'.format(summary['instructions_per_s'])
+            if summary.get('instructions_per_s') else ''))
+    rss = report['peak_rss_kib']
+    print('{:d} scripts, {:.1f} MB, peak RSS {}'.format(
+        report['files'], report['bytes'] / 1e6,
+        '{:.1f} MiB'.format(rss / 1024) if rss is not None else 'unavailable'))
+
+
+def compare(report, baseline, tolerance):
+    """
+    Print the throughput of each stage relative to `baseline`
+    Returns: list of the stages slower than baseline by more than `tolerance` (a fraction)
+    """
+    if (report['files'], report['bytes']) != (baseline['files'], baseline['bytes']):
+        print('warning: the baseline was measured on a different corpus '
+              '({:d} scripts, {:d} bytes)'.format(baseline['files'], baseline['bytes']))
+    if baseline.get('format') != report['format']:
+        print('warning: the baseline was saved by another version of this benchmark, '
+              'some stages may time different code paths')
+    regressions = []
+    for stage, summary in report['stages'].items():
+        reference = baseline['stages'].get(stage)
+        if reference is None or not reference['mb_per_s'] or not summary['mb_per_s']:
+            continue
+        ratio = summary['mb_per_s'] / reference['mb_per_s']
+        regressed = ratio < 1 - tolerance
+        if regressed:
+            regressions.append(stage)
+        print('{:<18} {:>10.2f} MB/s vs {:>10.2f} MB/s {:>+7.1%}{}'.format(
+            stage, summary['mb_per_s'], reference['mb_per_s'], ratio - 1,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def run(patterns, repeat=1, verbose=True):
+    """
+    Run the benchmark over all scripts matching `patterns`
+    Returns: dict report (see the JSON output)
+    """
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='bgi_bench')
+    try:
+        for script in get_corpus(patterns):
+            with open(script, 'rb') as infile:
+                data = infile.read()
+            stages, instructions, error = bench_script(data, workdir, repeat)
+            results[script] = {'bytes': len(data), 'instructions': instructions,
+                               'stages': stages, 'error': error}
+            if verbose:
+                print('{:<24} {:>9d} bytes {:>7d} instructions {:8.3f} ms{}'.format(
+                    os.path.basename(script), len(data), instructions,
+                    sum(stages.values()) * 1000, '  (partial: {})'.format(error) if error else ''))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'format': BENCH_FORMAT,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'files': len(results),
+        'bytes': sum(result['bytes'] for result in results.values()),
+        'peak_rss_kib': get_peak_rss(),
+        'stages': summarize(results),
+        'scripts': results,
+    }
+
+
+def bench_private_sequences(sizes=(1000, 10000, 100000)):
+    """
+    Time escaping/unescaping of strings made only of 0xFF.. sequences,
+    the worst case for private sequence handling. Cost should grow linearly.
+    """
+    for size in sizes:
+        data = b'\xFF\x01\x81\x40' * (size // 2)
+        start = time.perf_counter()
+        escaped = buriko_common.escape_private_sequences(data)
+        escape_time = time.perf_counter() - start
+        start = time.perf_counter()
+        unescaped = buriko_common.unescape_private_sequence(escaped)
+        unescape_time = time.perf_counter() - start
+        assert unescaped == data
+        print('private sequences x{:<7d} escape {:8.3f} ms  unescape {:8.3f} ms'.format(
+            size, escape_time * 1000, unescape_time * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the BGI tools over a corpus of compiled scripts.',
+        epilog='example: bgi_bench.py "input/*" "input_aiyoku/*" --json bench.json')
+    parser.add_argument('patterns', nargs='*',
+                        help='script file globs (default: the bundled input/ and input_aiyoku/)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='runs per script, the best time of each stage is kept (default: 1)')
+    parser.add_argument('--json', metavar='FILE', help='save the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare throughput against a JSON baseline saved by --json')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown allowed by --compare before failing (default: 0.1)')
+    parser.add_argument('--quiet', action='store_true', help='do not list scripts')
+    parser.add_argument('--private-sequences', action='store_true',
+                        help='only run the private sequence escaping benchmark')
+    args = parser.parse_args(argv)
+    if args.private_sequences:
+        bench_private_sequences()
+        return 0
+
+    report = run(args.patterns or DEFAULT_CORPUS, max(1, args.repeat), not args.quiet)
+    print_summary(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=1)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as infile:
+            baseline = json.load(infile)
+        if compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
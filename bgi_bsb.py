@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Binary intermediate (.bsb): compact alternative to the .bsd text written by bgidis,
+memory-mapped by bgias instead of being parsed back
+
+Layout (little-endian), every section following the previous one:
+  header: magic, version, flags (0), then the counts of instructions, arguments,
+    labels, defines and strings, and the header identifier (string index + 1, 0 if none)
+  opcodes: uint32 per instruction
+  args: int32 per argument token, the value of numbers, the string index otherwise
+  labels: pairs of uint32 (name string index, position in the code section)
+  defines: pairs of uint32 (name string index, value string index)
+  string ends: uint32 per string, end offset in the string data
+  counts: uint8 per instruction, number of argument tokens
+  kinds: uint8 per argument token, asdis.TOKEN_* kind
+  string data: UTF-8
+Argument tokens are those of .bsd lines (see asdis.parse_args()): strings are kept with
+their MSGID, and are only resolved against the .po file when assembling.
+
+Usage:
+  with bgi_bsb.load('itsusora/Scenario1234.bsb') as bsb:
+      bsd = bgi_bsb.to_bsd(bsb)
+  bsb_bytes = bgi_bsb.from_parsed(bgias.parse_bsd(bsd))
+"""
+import array
+import glob
+import io
+import mmap
+import os
+import struct
+import sys
+
+import asdis
+import bgi_common
+import bgi_log
+import bgiop
+import buriko_common
+import buriko_setup
+
+MAGIC = b'BSB\x1a'
+VERSION = 1
+
+# magic, version, flags, instructions, arguments, labels, defines, strings, header identifier
+header_struct = struct.Struct('<4sHHIIIIII')
+
+NUMBER_TOKENS = (asdis.TOKEN_INT, asdis.TOKEN_HEX)
+
+
+def _get_arg_kinds(op):
+    """
+    (Internal) Kinds of the argument tokens bgidis writes for `op`
+    Returns: tuple of int
+    """
+    fmt, pfmt, fcn = bgiop.ops[op]
+    if fcn == bgiop.get_string:
+        return asdis.TOKEN_MSGID, asdis.TOKEN_STRING
+    if fcn == bgiop.get_file:
+        return asdis.TOKEN_STRING, asdis.TOKEN_INT
+    if fcn == bgiop.get_offset:
+        return (asdis.TOKEN_SYMBOL,)
+    kind = asdis.TOKEN_HEX if '#x' in pfmt else asdis.TOKEN_INT
+    return (kind,) * (len(fmt) - 1)
+
+
+def _cast_column(view, typecode):
+    """
+    (Internal) Zero-copy view of a little-endian column, copied on big-endian hosts
+    Returns: memoryview or array
+    """
+    if typecode == 'B' or sys.byteorder == 'little':
+        return view.cast(typecode)
+    column = array.array(typecode, view.tobytes())
+    column.byteswap()
+    return column
+
+
+class Bsb:
+    """
+    Binary intermediate held in `data` (any bytes-like object, see load() for files)
+    Columns are views of `data`, strings and tables are decoded upfront.
+    Properties:
+      data: contents of the .bsb
+      hdrtext: header identifier, or None
+      defines: dict { name: value } (see bgias.parse_bsd())
+      labels: dict { name: position in the code section }
+      opcodes, counts: opcode and number of argument tokens of each instruction
+      kinds, args: asdis.TOKEN_* kind and value of each argument token
+      strings: array of str, referenced by index from the above
+      codesize: size of the code section
+    Views must be released with close() before `data` can be unmapped.
+    """
+
+    def __init__(self, data, name='<bsb>'):
+        self.data = data
+        self.name = name
+        self._view = memoryview(data)
+        self._columns = []
+        try:
+            self._read()
+        except Exception:  # pylint: disable=broad-except
+            # release the views on any error, corrupt files included
+            self.close()
+            raise
+
+    def _read(self):
+        name = self.name
+        try:
+            fields = header_struct.unpack_from(self._view)
+        except struct.error:
+            raise bgi_common.BgiCustomException('{}: not a .bsb file'.format(name))
+        magic, version, _, ninstrs, nargs, nlabels, ndefines, nstrings, header = fields
+        if magic != MAGIC:
+            raise bgi_common.BgiCustomException('{}: not a .bsb file'.format(name))
+        if version != VERSION:
+            raise bgi_common.BgiCustomException(
+                '{}: unsupported .bsb version {:d}'.format(name, version))
+        pos = header_struct.size
+        sections = []
+        for size, typecode in ((4 * ninstrs, 'I'), (4 * nargs, 'i'), (8 * nlabels, 'I'),
+                               (8 * ndefines, 'I'), (4 * nstrings, 'I'),
+                               (ninstrs, 'B'), (nargs, 'B')):
+            if pos + size > len(self._view):
+                raise bgi_common.BgiCustomException('{}: truncated .bsb file'.format(name))
+            sections.append(self._get_column(self._view[pos:pos + size], typecode))
+            pos += size
+        self.opcodes, self.args, labels, defines, ends, self.counts, self.kinds = sections
+        if sum(self.counts) != nargs:
+            raise bgi_common.BgiCustomException(
+                '{}: argument counts do not match the arguments'.format(name))
+        blob = self._view[pos:]
+        self._columns.append(blob)
+        self.strings = []
+        start = 0
+        try:
+            for end in ends:
+                if not start <= end <= len(blob):
+                    raise ValueError('string ends out of order')
+                self.strings.append(str(blob[start:end], 'utf-8'))
+                start = end
+        except ValueError as exc:  # UnicodeDecodeError included
+            raise bgi_common.BgiCustomException('{}: invalid strings ({})'.format(name, exc))
+        if header > nstrings or any(idx >= nstrings for idx in labels[::2]) or any(
+                idx >= nstrings for idx in defines) or any(
+                    not 0 <= value < nstrings for kind, value in zip(self.kinds, self.args)
+                    if kind not in NUMBER_TOKENS):
+            raise bgi_common.BgiCustomException('{}: string index out of range'.format(name))
+        if any(kind > asdis.TOKEN_MSGID for kind in self.kinds):
+            raise bgi_common.BgiCustomException('{}: unknown argument kind'.format(name))
+        if any(opcode not in bgiop.sizes for opcode in self.opcodes):
+            raise bgi_common.BgiCustomException('{}: unknown opcode'.format(name))
+        self.hdrtext = self.strings[header - 1] if header else None
+        self.labels = {self.strings[labels[idx]]: labels[idx + 1]
+                       for idx in range(0, len(labels), 2)}
+        self.defines = {self.strings[defines[idx]]: self.strings[defines[idx + 1]]
+                        for idx in range(0, len(defines), 2)}
+        self.codesize = sum(bgiop.sizes[opcode] for opcode in self.opcodes)
+
+    def _get_column(self, view, typecode):
+        column = _cast_column(view, typecode)
+        self._columns.append(view)
+        if isinstance(column, memoryview):
+            self._columns.append(column)
+        return column
+
+    def close(self):
+        """
+        Release the views of `data`, and unmap it if it was mapped by load()
+        """
+        for view in reversed(self._columns):
+            view.release()
+        self._columns = []
+        self._view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(path):
+    """
+    Memory-map a .bsb file
+    Returns: Bsb (to be closed, or used as a context manager)
+    """
+    with open(path, 'rb') as infile:
+        try:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            raise bgi_common.BgiCustomException('{}: not a .bsb file'.format(path))
+    return Bsb(data, path)
+
+
+class _Writer:
+    """
+    (Internal) Accumulates the sections of a .bsb, strings being stored once
+    """
+
+    def __init__(self):
+        self.strings = {}
+        self.opcodes = array.array('I')
+        self.args = array.array('i')
+        self.labels = array.array('I')
+        self.defines = array.array('I')
+        self.counts = bytearray()
+        self.kinds = bytearray()
+
+    def intern(self, text):
+        idx = self.strings.get(text)
+        if idx is None:
+            idx = self.strings[text] = len(self.strings)
+        return idx
+
+    def getvalue(self, hdrtext):
+        header = self.intern(hdrtext) + 1 if hdrtext else 0
+        blob = bytearray()
+        ends = array.array('I')
+        for text in self.strings:  # in order of their indexes
+            blob += text.encode('utf-8')
+            ends.append(len(blob))
+        outfile = io.BytesIO()
+        outfile.write(header_struct.pack(MAGIC, VERSION, 0, len(self.opcodes), len(self.args),
+                                         len(self.labels) // 2, len(self.defines) // 2,
+                                         len(ends), header))
+        for column in (self.opcodes, self.args, self.labels, self.defines, ends):
+            if sys.byteorder != 'little':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            outfile.write(column)
+        outfile.write(self.counts)
+        outfile.write(self.kinds)
+        outfile.write(blob)
+        return outfile.getvalue()
+
+
+def from_parsed(parsed):
+    """
+    Encode .bsd data from bgias.parse_bsd() as a .bsb
+    Returns: bytes
+    """
+    instrs, labels, _, hdrtext, defines = parsed
+    writer = _Writer()
+    if hdrtext:
+        writer.intern(hdrtext)
+    for name, value in defines.items():
+        writer.defines.extend((writer.intern(name), writer.intern(value)))
+    for name, pos in labels.items():
+        writer.labels.extend((writer.intern(name), pos))
+    for fcn, args, _, linenum in instrs:
+        writer.opcodes.append(bgiop.rops[fcn])
+        if len(args) > 0xFF:
+            raise asdis.InvalidInstructionFormat(
+                'Too many arguments @ line {:d}'.format(linenum))
+        writer.counts.append(len(args))
+        for kind, value in args:
+            writer.kinds.append(kind)
+            try:
+                writer.args.append(value if kind in NUMBER_TOKENS else writer.intern(value))
+            except OverflowError:
+                raise asdis.InvalidInstructionFormat(
+                    'Integer out of range @ line {:d}'.format(linenum))
+    return writer.getvalue(hdrtext)
+
+
+def from_instrs(inst, offsets, hdrtext, defines):
+    """
+    Encode data gathered from bgidis.parse() as a .bsb, without formatting any text
+    Same output as from_parsed(bgias.parse_bsd(...)) of what bgidis.out() writes.
+    Returns: bytes
+    """
+    writer = _Writer()
+    if hdrtext:
+        writer.intern(hdrtext)
+    for offset in sorted(defines):
+        writer.defines.extend((writer.intern(defines[offset]), writer.intern('L%05x' % offset)))
+    for addr in inst.addrs:
+        if addr in offsets or addr in defines:
+            writer.labels.extend((writer.intern(defines.get(addr, 'L%05x' % addr)), addr))
+    code = inst.code
+    msgid = 0
+    unpack_arg = struct.Struct('<i').unpack_from
+    for addr, opcode, arg in zip(inst.addrs, inst.opcodes, inst.args):
+        writer.opcodes.append(opcode)
+        kinds = arg_kinds[opcode]
+        writer.counts.append(len(kinds))
+        if not kinds:
+            continue
+        writer.kinds.extend(kinds)
+        fcn = bgiop.ops[opcode][2]
+        if fcn == bgiop.get_string:
+            msgid += 1
+            text = buriko_common.get_escaped_text(buriko_common.read_cstring(code, arg))
+            writer.args.extend((writer.intern('%04d' % msgid),
+                                writer.intern(text.decode(buriko_setup.senc))))
+        elif fcn == bgiop.get_file:
+            text = buriko_common.read_cstring(code, arg).decode(buriko_setup.senc)
+            writer.args.extend((writer.intern(text), unpack_arg(code, addr + 8)[0]))
+        elif fcn == bgiop.get_offset:
+            writer.args.append(writer.intern(defines.get(arg, 'L%05x' % arg)))
+        else:
+            writer.args.append(arg - 0x100000000 if arg > 0x7FFFFFFF else arg)
+    return writer.getvalue(hdrtext)
+
+
+def format_arg(bsb, kind, value):
+    """
+    Format an argument token as in a .bsd
+    Returns: str
+    """
+    if kind == asdis.TOKEN_INT:
+        return '%d' % value
+    if kind == asdis.TOKEN_HEX:
+        return '%#x' % value
+    if kind == asdis.TOKEN_STRING:
+        return '"%s"' % asdis.escape(bsb.strings[value])
+    if kind == asdis.TOKEN_MSGID:
+        return 'MSGID::' + bsb.strings[value]
+    return bsb.strings[value]
+
+
+def to_bsd(bsb):
+    """
+    Write a .bsb back as .bsd text, laid out as bgidis.out() does
+    Returns: str
+    """
+    names = {op: fcn for fcn, op in bgiop.rops.items()}
+    labels = {}
+    for name, pos in bsb.labels.items():
+        labels.setdefault(pos, []).append(name)
+    bsdfile = io.StringIO()
+    if bsb.hdrtext:
+        bsdfile.write('#header "%s"\n\n' % asdis.escape(bsb.hdrtext))
+    if bsb.defines:
+        for name, value in bsb.defines.items():
+            bsdfile.write('#define %s %s\n' % (name, value))
+        bsdfile.write('\n')
+    pos = 0
+    idx = 0
+    for opcode, count in zip(bsb.opcodes, bsb.counts):
+        fcn = names[opcode]
+        if fcn == 'line':
+            bsdfile.write('\n')
+        for name in labels.pop(pos, ()):
+            bsdfile.write('\n%s:\n' % name)
+        args = ', '.join(format_arg(bsb, bsb.kinds[argidx], bsb.args[argidx])
+                         for argidx in range(idx, idx + count))
+        bsdfile.write('\t%s(%s);\n' % (fcn, args))
+        pos += bgiop.sizes[opcode]
+        idx += count
+    for pos in sorted(labels):  # past the last instruction
+        for name in labels[pos]:
+            bsdfile.write('\n%s:\n' % name)
+    return bsdfile.getvalue()
+
+
+def convert(path):
+    """
+    Convert a .bsd file to .bsb, or a .bsb file back to .bsd, next to it
+    Emits a 'convert' event
+    """
+    # bgias imports this module to assemble .bsb files
+    import bgias  # pylint: disable=import-outside-toplevel
+    base, ext = os.path.splitext(path)
+    with bgi_log.timed('convert', file=path) as event:
+        if ext == '.bsb':
+            with load(path) as bsb:
+                bsd = to_bsd(bsb)
+            with open(base + '.bsd', 'w', encoding='utf-8-sig') as bsdfile:
+                bsdfile.write(bsd)
+            event['bytes'] = len(bsd)
+        else:
+            with open(path, 'r', encoding='utf-8-sig') as bsdfile:
+                bsb_bytes = from_parsed(bgias.parse_bsd(bsdfile.read()))
+            with open(base + '.bsb', 'wb') as bsbfile:
+                bsbfile.write(bsb_bytes)
+            event['bytes'] = len(bsb_bytes)
+
+
+arg_kinds = {op: _get_arg_kinds(op) for op in bgiop.ops}
+
+
+if __name__ == '__main__':
+    args = bgi_log.parse_args(sys.argv[1:])
+    if not args:
+        print('Usage: bgi_bsb.py <file(s)>')
+        print('Converts .bsd files to .bsb, and .bsb files back to .bsd')
+        print('(other files amongst <file(s)> are skipped)')
+        print(bgi_log.USAGE)
+        sys.exit(1)
+    for arg in args:
+        for bsdpath in glob.glob(arg):
+            if os.path.splitext(bsdpath)[1] in ('.bsd', '.bsb'):
+                convert(bsdpath)
@@ -0,0 +1,154 @@
+"""
+Content-addressed, on-disk cache of script decoding results (disassembly, code-section records)
+
+Entries are keyed by the SHA-256 of the script bytes, the settings that affect decoding
+and the tool sources, so they never need invalidating: unchanged scripts are served from
+the cache across branches and runs. Least recently used entries are evicted when the
+cache grows over its size limit.
+
+Usage:
+  cache = bgi_cache.get_default()  # None when disabled in buriko_setup.py
+  script = bgi_script.Script(data, cache)
+"""
+import hashlib
+import importlib
+import os
+
+import bgi_setup
+import buriko_common
+import buriko_setup
+
+
+# modules whose code affects cached results
+TOOL_MODULES = ('asdis', 'bgi_bsb', 'bgi_common', 'bgi_config', 'bgi_dumppo', 'bgi_po',
+                'bgi_script', 'bgidis', 'bgiop', 'buriko_common', 'polib')
+
+CACHE_EXT = '.bin'
+
+
+def get_settings():
+    """
+    Settings affecting decoding results
+    Returns: tuple
+    """
+    return (bgi_setup.senc, bgi_setup.slang, tuple(bgi_setup.dlang), bgi_setup.dcopy,
+            buriko_setup.senc)
+
+
+def get_tool_digest(modules=TOOL_MODULES):
+    """
+    Hash of the sources of `modules` (names), so that updating the tools invalidates
+    cached results (default: the decoding sources) or previous builds (see bgias)
+    Returns: str
+    """
+    if modules not in _tool_digests:
+        digest = hashlib.sha256()
+        for name in modules:
+            with open(importlib.import_module(name).__file__, 'rb') as srcfile:
+                digest.update(srcfile.read())
+        _tool_digests[modules] = digest.hexdigest()
+    return _tool_digests[modules]
+
+
+_tool_digests = {}
+
+
+class DecodeCache:
+    """
+    Directory of marshal'd results named after their key, bounded to `max_size` bytes
+    The modification time of an entry is its last use. The size of the directory is
+    scanned on the first store, then estimated from the stored entries: it is only
+    scanned again (and entries evicted) once the estimate goes over `max_size`.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None  # estimated size of the directory, None until scanned
+
+    def get_key(self, digest, stage):
+        """
+        `digest` is the SHA-256 of the script bytes (see buriko_common.get_digest())
+        Returns: str
+        """
+        key = repr((digest, stage, get_settings(), get_tool_digest()))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + CACHE_EXT)
+
+    def load(self, key):
+        """
+        Returns: the cached object, or None
+        """
+        path = self._get_path(key)
+        value = buriko_common.load_build_file(path)
+        if value is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass  # evicted meanwhile by another process
+        return value
+
+    def store(self, key, value):
+        """
+        Cache a marshal-able object, evicting entries when over the size limit
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(key)
+        buriko_common.save_build_file(path, value)
+        if self._size is None:
+            self.evict()
+            return
+        try:
+            self._size += os.path.getsize(path)
+        except OSError:
+            pass  # evicted meanwhile by another process
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size bytes
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as direntries:
+            for direntry in direntries:
+                if not direntry.name.endswith(CACHE_EXT):
+                    continue
+                try:
+                    stat = direntry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, direntry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+
+def get_default():
+    """
+    Cache configured by buriko_setup.decode_cache_size, in the project folder
+    (the same instance for the whole process, as long as the settings do not change)
+    Returns: DecodeCache, or None when disabled
+    """
+    global _default  # pylint: disable=global-statement
+    if not buriko_setup.decode_cache_size:
+        return None
+    directory = os.path.join(buriko_setup.project_name, '.cache')
+    if (_default is None or _default.directory != directory or
+            _default.max_size != buriko_setup.decode_cache_size):
+        _default = DecodeCache(directory, buriko_setup.decode_cache_size)
+    return _default
+
+
+_default = None
@@ -2,14 +2,21 @@
 Common routines for handling BGI scripts
 """
 
+import array
+import bisect
+import itertools
+import re
 import struct
 import os
-import sys
 import errno
 
 import bgi_config
 import bgi_setup
 
+import asdis
+import bgiop
+import buriko_common
+
 
 class BgiCustomException(Exception):
     """
@@ -85,15 +92,32 @@ def get_dword(data, offset):
     return struct.unpack('<I', data)[0]
 
 
-def escape_private_sequence(data):
+def find_string_refs(instrs, optypes):
     """
-    Escape a non-standard DBCS char outside of cp932 (not private area either)
-    Expects a 2-byte long bytes string
-    Example: b"\xFF\x03"
-    Returns: bytes
+    Collect string references from decoded bgiop.Instructions
+    A reference is the first argument of an instruction whose opcode is in `optypes`.
+    Returns: list of tuple (argument offset, opcode, address), in ascending order
+    """
+    return [(addr + 4, opcode, arg)
+            for addr, opcode, arg in zip(instrs.addrs, instrs.opcodes, instrs.args)
+            if opcode in optypes]
+
+
+def scan_string_refs(dwords, addresses, optypes):
+    """
+    Heuristic fallback of find_string_refs() for bytecode that cannot be decoded.
+    A reference is a dword found in `addresses` which immediately follows
+    a dword found in `optypes`. The first dword is never a reference.
+    Returns: list of tuple (argument offset, type, address), in ascending order
     """
-    value = struct.unpack('>H', data)[0]
-    return '&#{:04X}'.format(value).encode("ASCII")  # len() of this string must be an even number
+    candidates = itertools.compress(itertools.count(1),
+                                    map(addresses.__contains__, dwords[1:]))
+    return [(idx * 4, dwords[idx - 1], dwords[idx]) for idx in candidates
+            if dwords[idx - 1] in optypes]
+
+
+escape_private_sequence = buriko_common.escape_private_sequence
+unescape_private_sequence = buriko_common.unescape_private_sequence
 
 
 def get_escaped_text(text):
@@ -102,89 +126,153 @@ def get_escaped_text(text):
     Returns: bytes
     """
     if bgi_setup.is_jis_source():
-        while (text.find(b'\xFF') % 2) == 0:
-            pvofs = text.find(b'\xFF')
-            text = text[:pvofs] + \
-                escape_private_sequence(text[pvofs:pvofs + 2]) + \
-                text[pvofs + 2:]
+        text = buriko_common.escape_private_sequences(text)
     return text
 
 
-def unescape_private_sequence(value):
+get_section_boundary = buriko_common.get_section_boundary
+
+def get_define_offsets(hdr):
     """
-    `value` must be a bytes representation in target encoding bgi_setup.ienc
+    Read the code offsets of the define table of a BGI script header (see bgidis.parse_hdr())
+    Returns: list of int
     """
-    while True:
-        seqofs = value.find(b"&#")
-        if seqofs == -1:
-            break
-        hexval = value[seqofs + 2: seqofs + 6].decode('ASCII')
-        value = value[:seqofs] + bytes(bytearray.fromhex(hexval)) + value[seqofs + 6:]
-    return value
-
-
-def get_section_boundary(data):
+    hdr = bytes(hdr)
+    entries = get_dword(hdr, 0x24) or 0
+    offsets = []
+    pos = 0x28
+    for _ in range(entries):
+        pos = hdr.find(b'\x00', pos) + 1
+        offset = get_dword(hdr, pos)
+        if pos == 0 or offset is None:
+            break  # truncated table
+        offsets.append(offset)
+        pos += 4
+    return offsets
+
+
+def get_code_layout(data):
     """
-    Scans a BGI script buffer for the boundary before the text section
+    Locate the code section of a BGI script buffer
     ---
-    This is somewhat of a kludge to get the beginning of the text section as it assumes
-    that the code section ends with the byte sequence: 1B 00 00 00
-    (this is probably a return or exit command).
-    Returns: integer offset of boundary, or -1
+    The code section follows the header, whose size is given by the version config
+    (and the HDRAS_POS field). Its instructions are decoded up to the first string
+    they reference, where the text section begins (see bgiop.decode()); the entry
+    points of the header's define table must all lie before that boundary.
+    When the bytecode cannot be decoded that way, get_section_boundary() scans for
+    the last return instead.
+    Nothing is cached here, so that buffers are not kept alive: bgi_script.Script keeps
+    the layout and instructions of its script (and stores the layout in the decode cache).
+    `data` may be any bytes-like object (bytes, memoryview, mmap)
+    Returns: tuple (int header size, int boundary, bgiop.Instructions or None)
     """
-    pos = -1
-    while 1:
-        res = data.find(b'\x1B\x00\x00\x00', pos + 1)
-        if res == -1:
-            break
-        pos = res
-    return pos + 4
+    config = bgi_config.get_config(data)
+    hdr_size = config['HDR_SIZE']
+    if config['HDRAS_POS'] is not None:
+        hdr_size += get_dword(data, config['HDRAS_POS'])
+    try:
+        instrs = bgiop.decode(memoryview(data)[hdr_size:])
+        if all(offset < instrs.size for offset in get_define_offsets(data[:hdr_size])):
+            return hdr_size, hdr_size + instrs.size, instrs
+    except asdis.InvalidBytecode:
+        pass
+    return hdr_size, max(hdr_size, get_section_boundary(data)), None
 
 
-def split_data(data):
+def split_data(data, zero_copy=False):
     """
-    Split a BGI script buffer into its components
+    Split a BGI script buffer into its components (see get_code_layout())
+    `data` may be any bytes-like object, components are then slices of the same type,
+    or memoryviews sharing its memory with `zero_copy`
     Returns: (bytes, bytes, bytes, dict: info on detected script version)
     """
     config = bgi_config.get_config(data)
-    section_boundary = get_section_boundary(data)
-    hdr_size = config['HDR_SIZE']
-    if config['HDRAS_POS'] is not None:
-        hdr_size += get_dword(data, config['HDRAS_POS'])
+    hdr_size, section_boundary, _ = get_code_layout(data)
+    if zero_copy:
+        data = memoryview(data)
     hdr_bytes = data[:hdr_size]
     code_bytes = data[hdr_size:section_boundary]
     text_bytes = data[section_boundary:]
     return hdr_bytes, code_bytes, text_bytes, config
 
 
-def get_text_section(text_bytes, decode_binstrings=True):
+re_nul = re.compile(b'\x00')
+
+
+def get_text_spans(text_bytes):
     """
-    Parses a BGI text buffer into a dictionary whose keys are offsets.
-    `decode_binstrings` decides whether to decode them to str or
-    leave them as a bytes object
-    Returns: a dict {offset: str} or {offset: bytes}
+    Locate the strings of a BGI text buffer without copying it
+    (trailing NUL bytes are padding, not empty strings)
+    `text_bytes` may be any bytes-like object (bytes, memoryview, mmap)
+    Returns: tuple (array.array('I') offsets in ascending order,
+                    array.array('I') lengths excluding the NUL terminator)
     """
+    offsets = array.array('I')
+    lengths = array.array('I')
     if len(text_bytes) == 0 or text_bytes == b'\x00':
-        return {}
-    binstrings = text_bytes.rstrip(b'\x00').split(b'\x00')
-    text_section = {}
-    pos = 0
-    for binstring in binstrings:
-        raw_length = len(binstring) + 1
-        try:
-            text = binstring.decode(bgi_setup.senc) if decode_binstrings else binstring
-        except UnicodeDecodeError as exc:
-            with open('DEBUG.bin', 'wb') as out:
-                out.write(binstring)
-            raise BgiCustomException(
-                "ERROR decoding text @{0:04X} to @{1:04X} - {2}: {3}".format(
-                    pos, pos + raw_length, sys.exc_info()[0], exc
-                )
-            )
-        text_section[pos] = text
-        pos += raw_length
+        return offsets, lengths
+    nuls = [match.start() for match in re_nul.finditer(text_bytes)]
+    end = len(text_bytes)
+    while nuls and nuls[-1] == end - 1:
+        nuls.pop()
+        end -= 1
+    offsets.append(0)
+    offsets.extend(nul + 1 for nul in nuls)
+    lengths.extend(nul - pos for pos, nul in zip(offsets, nuls))
+    lengths.append(end - offsets[-1])
+    return offsets, lengths
+
+
+class TextTable:
+    """
+    Strings of a BGI text buffer, indexed by their offset in the buffer
+    Strings stay in the buffer until asked for, decoded strings are kept for later calls.
+    Properties:
+      text_bytes: the text buffer (any bytes-like object)
+      offsets, lengths: see get_text_spans()
+    """
+    __slots__ = ('text_bytes', 'offsets', 'lengths', '_texts', '_escaped_texts')
 
-    return text_section
+    def __init__(self, text_bytes):
+        self.text_bytes = text_bytes
+        self.offsets, self.lengths = get_text_spans(text_bytes)
+        self._texts = {}
+        self._escaped_texts = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __contains__(self, offset):
+        idx = bisect.bisect_left(self.offsets, offset)
+        return idx < len(self.offsets) and self.offsets[idx] == offset
+
+    def get_bytes(self, offset):
+        """
+        Copy the string at `offset` out of the text buffer
+        Returns: bytes (KeyError if no string starts there)
+        """
+        idx = bisect.bisect_left(self.offsets, offset)
+        if idx == len(self.offsets) or self.offsets[idx] != offset:
+            raise KeyError(offset)
+        return bytes(self.text_bytes[offset:offset + self.lengths[idx]])
+
+    def get_text(self, offset, escaped=False):
+        """
+        Decode the string at `offset`, with 0xFF.. sequences escaped if `escaped`
+        (see get_escaped_text())
+        Returns: str (KeyError if no string starts there)
+        """
+        texts = self._escaped_texts if escaped else self._texts
+        text = texts.get(offset)
+        if text is None:
+            binstring = self.get_bytes(offset)
+            if escaped:
+                binstring = get_escaped_text(binstring)
+            text = texts[offset] = binstring.decode(bgi_setup.senc)
+        return text
 
 
 def check(code_bytes, pos, cfcn, cpos):
@@ -196,6 +284,64 @@ def check(code_bytes, pos, cfcn, cpos):
             cfcn == get_dword(code_bytes, pos + cpos))
 
 
+# record markers (see Record), MARKERS holding the letter of each in PO ids
+MARKER_NAME, MARKER_TEXT, MARKER_OTHER = range(3)
+MARKERS = ('N', 'T', 'Z')
+
+# record comment kinds (see Record.get_comment())
+(COMMENT_NAME, COMMENT_TEXT, COMMENT_RUBY_KANJI, COMMENT_RUBY_FURIGANA, COMMENT_BACKLOG,
+ COMMENT_OTHER) = range(6)
+COMMENTS = ('NAME', 'TEXT', 'TEXT RUBY KANJI', 'TEXT RUBY FURIGANA', 'TEXT BACKLOG', 'OTHER')
+
+
+class Record:
+    """
+    A string referenced by the code section
+    Properties:
+      text: decoded string
+      numid: number of the string amongst those with the same marker
+      marker: MARKER_NAME, MARKER_TEXT or MARKER_OTHER
+      kind: one of the COMMENT_* values
+      name: speaker name of a text line (shared with the TextTable), or None
+    """
+    __slots__ = ('text', 'numid', 'marker', 'kind', 'name')
+
+    def __init__(self, text, numid, marker, kind, name=None):
+        self.text = text
+        self.numid = numid
+        self.marker = marker
+        self.kind = kind
+        self.name = name
+
+    def get_marker(self):
+        """
+        Returns: str 'N', 'T' or 'Z'
+        """
+        return MARKERS[self.marker]
+
+    def get_comment(self):
+        """
+        Render the comment of the record, as written to PO files
+        Returns: str
+        """
+        if self.name is not None:
+            return 'TEXT 【%s】' % self.name
+        return COMMENTS[self.kind]
+
+    def to_tuple(self):
+        """
+        Returns: tuple of the properties, the marshal-able form of the record
+        """
+        return self.text, self.numid, self.marker, self.kind, self.name
+
+    @classmethod
+    def from_tuple(cls, values):
+        """
+        Returns: Record, from the result of to_tuple()
+        """
+        return cls(*values)
+
+
 class CodeSectionState:
     """
     Usage:
@@ -209,46 +355,74 @@ class CodeSectionState:
         """
         self._initialize_state(None, None, None)
 
-    def get_code_section(self, code_bytes, text_bytes, config):
+    def get_code_section(self, code_bytes, text_bytes, config, instrs=None):
         """
         Parses the BGI code buffer and associates offsets to misc info.
         Also detects orphaned strings (unused strings in `text_bytes`)
-        Returns: tuple (dict {offset: RECORD}, dict {offset: bytes})
+        Strings are only copied out of `text_bytes` (see TextTable) for the records
+        and orphans returned, so the buffers may be memoryviews of the whole script.
+        `instrs` may hold the already decoded instruction stream of `code_bytes`
+        (see bgiop.decode)
+        Returns: tuple (dict {offset: Record}, dict {offset: bytes})
         """
         self._initialize_state(code_bytes, text_bytes, config)
         code_section = {}
-        matched_pos = {}
-        pos = 4
-        while pos < len(code_bytes):
-            optype = get_dword(code_bytes, pos - 4)
-            dword = get_dword(code_bytes, pos)
-            text_addr = dword - len(code_bytes)
-            # check if address is in text section and data type is string or file
-            if text_addr in self.text_section:
-                matched_pos[text_addr] = True
-                text = self.text_section[text_addr]
-                if optype == config['STR_TYPE']:
-                    text = get_escaped_text(text).decode(bgi_setup.senc)
-                    code_section[pos] = self._make_record_for_strtype(text, pos)
-                elif optype == config['FILE_TYPE']:
-                    text = text.decode(bgi_setup.senc)
-                    code_section[pos] = self._make_record_for_filetype(text)
-            pos += 4
-        unmatched_strings = {key: value for key, value
-                             in self.text_section.items()
-                             if key not in matched_pos}
+        code_size = len(code_bytes)
+        # absolute addresses of strings, as they appear in the bytecode
+        table = self.text_table
+        optypes = (config['STR_TYPE'], config['FILE_TYPE'])
+        try:
+            if instrs is None:
+                instrs = bgiop.decode(code_bytes, code_size)
+            refs = find_string_refs(instrs, optypes)
+            matched_addr = {address for _, _, address in refs}
+        except asdis.UnknownOpcode:
+            # newer engine revision, fall back to scanning for dword patterns
+            addresses = {offset + code_size for offset in table}
+            refs = scan_string_refs(self.dwords, addresses, optypes)
+            matched_addr = addresses.intersection(self.dwords[1:])
+        for pos, optype, address in refs:
+            offset = address - code_size
+            if offset not in table:
+                continue
+            # check if data type is string or file
+            if optype == config['STR_TYPE']:
+                text = table.get_text(offset, escaped=True)
+                code_section[pos] = self._make_record_for_strtype(text, pos)
+            else:
+                text = table.get_text(offset)
+                code_section[pos] = self._make_record_for_filetype(text)
+        unmatched_strings = {key: table.get_bytes(key) for key in table
+                             if key + code_size not in matched_addr}
         return code_section, unmatched_strings
 
     def _initialize_state(self, code_bytes, text_bytes, config):
         self.code_bytes = code_bytes
+        # zero-copy view of the code dwords on little-endian hosts
+        self.dwords = bgiop.get_dwords(memoryview(code_bytes)) if code_bytes is not None else None
         self.config = config
-        self.text_section = None
+        self.text_table = None
         if text_bytes is not None:
-            self.text_section = get_text_section(text_bytes, False)
-        self.ids = {'N': 1, 'T': 1, 'Z': 1}
+            self.text_table = TextTable(text_bytes)
+        self.ids = [1] * len(MARKERS)
         self.names = {}
         self.others = {}
 
+    def _get_dword(self, offset):
+        """
+        Same as get_dword() on the code buffer, for dword-aligned offsets
+        """
+        idx = offset >> 2
+        if 0 <= idx < len(self.dwords):
+            return self.dwords[idx]
+        return None
+
+    def _check(self, pos, cfcn, cpos):
+        """
+        Same as check() on the code buffer, for dword-aligned offsets
+        """
+        return cfcn is not None and cfcn == self._get_dword(pos + cpos)
+
     def _get_id_and_increment(self, markertype):
         numid = self.ids[markertype]
         self.ids[markertype] += 1
@@ -258,60 +432,57 @@ class CodeSectionState:
         """
         Handle a subcase of get_code_section()
         """
-        if check(self.code_bytes, pos,
-                 self.config['TEXT_FCN'], self.config['NAME_POS']):  # check if name (0140)
-            marker = 'N'
-            comment = 'NAME'
+        name = None
+        if self._check(pos,
+                       self.config['TEXT_FCN'], self.config['NAME_POS']):  # check if name (0140)
+            marker = MARKER_NAME
+            kind = COMMENT_NAME
             if text not in self.names:
                 self.names[text] = self._get_id_and_increment(marker)
             numid = self.names[text]
-        elif check(self.code_bytes, pos,
-                   self.config['TEXT_FCN'], self.config['TEXT_POS']):  # check if text (0140)
-            marker = 'T'
-            name_dword = get_dword(self.code_bytes,
-                                   pos + self.config['TEXT_POS'] - self.config['NAME_POS'])
+        elif self._check(pos,
+                         self.config['TEXT_FCN'], self.config['TEXT_POS']):  # check if text (0140)
+            marker = MARKER_TEXT
+            kind = COMMENT_TEXT
+            name_dword = self._get_dword(pos + self.config['TEXT_POS'] - self.config['NAME_POS'])
             if name_dword != 0:
                 try:
                     name_addr = name_dword - len(self.code_bytes)
-                    name = self.text_section[name_addr].decode(bgi_setup.senc)
-                    comment = 'TEXT 【%s】' % name
+                    name = self.text_table.get_text(name_addr)
                 except KeyError:
-                    comment = 'TEXT'
-            else:
-                comment = 'TEXT'
+                    pass
             numid = self._get_id_and_increment(marker)
-        elif check(self.code_bytes, pos,
-                   self.config['RUBY_FCN'], self.config['RUBYK_POS']):  # check if ruby kanji (014b)
-            marker = 'T'
-            comment = 'TEXT RUBY KANJI'
+        elif self._check(pos,
+                         self.config['RUBY_FCN'],
+                         self.config['RUBYK_POS']):               # check if ruby kanji (014b)
+            marker = MARKER_TEXT
+            kind = COMMENT_RUBY_KANJI
             numid = self._get_id_and_increment(marker)
-        elif check(self.code_bytes, pos,
-                   self.config['RUBY_FCN'],
-                   self.config['RUBYF_POS']):                     # check if ruby furigana (014b)
-            marker = 'T'
-            comment = 'TEXT RUBY FURIGANA'
+        elif self._check(pos,
+                         self.config['RUBY_FCN'],
+                         self.config['RUBYF_POS']):               # check if ruby furigana (014b)
+            marker = MARKER_TEXT
+            kind = COMMENT_RUBY_FURIGANA
             numid = self._get_id_and_increment(marker)
-        elif check(self.code_bytes, pos,
-                   self.config['BKLG_FCN'],
-                   self.config['BKLG_POS']):                      # check if backlog text (0143)
-            marker = 'T'
-            comment = 'TEXT BACKLOG'
+        elif self._check(pos,
+                         self.config['BKLG_FCN'],
+                         self.config['BKLG_POS']):                # check if backlog text (0143)
+            marker = MARKER_TEXT
+            kind = COMMENT_BACKLOG
             numid = self._get_id_and_increment(marker)
         else:
-            marker = 'Z'
-            comment = 'OTHER'
+            marker = MARKER_OTHER
+            kind = COMMENT_OTHER
             if text not in self.others:
                 self.others[text] = self._get_id_and_increment(marker)
             numid = self.others[text]
-        return text, numid, marker, comment  # record
+        return Record(text, numid, marker, kind, name)
 
     def _make_record_for_filetype(self, text):
         """
         Handle a subcase of get_code_section()
         """
-        marker = 'Z'
-        comment = 'OTHER'
         if text not in self.others:
-            self.others[text] = self._get_id_and_increment(marker)
+            self.others[text] = self._get_id_and_increment(MARKER_OTHER)
         numid = self.others[text]
-        return text, numid, marker, comment  # record
+        return Record(text, numid, MARKER_OTHER, COMMENT_OTHER)
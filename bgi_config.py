@@ -26,6 +26,7 @@ VER000 = {
 }
 
 # header beginning with "BurikoCompiledScriptVer1.00"
+VER100_MAGIC = b'BurikoCompiledScriptVer1.00\x00'
 VER100 = {
     'HDR_SIZE': 0x1C,    # base header size
     'HDRAS_POS': 0x1C,   # offset of additional header data size (set to None if not used)
@@ -50,7 +51,7 @@ def get_config(data):
     select which version based on known header string
     Returns: dict
     """
-    if data.startswith(b'BurikoCompiledScriptVer1.00\x00'):
+    if data[:len(VER100_MAGIC)] == VER100_MAGIC:
         config = VER100
     else:
         config = VER000
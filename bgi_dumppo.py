@@ -2,15 +2,20 @@
 """
 Dumps a BGI script to GetText PO
 """
+import collections
 import glob
 import os
 import sys
 import re
 
+import bgi_cache
 import bgi_common
-import bgi_po
+import bgi_log
+import bgi_script
 import bgi_setup
 
+log = bgi_log.get_logger('dumppo')
+
 
 def dump_text(filebuf, marker, numid, text, comment, binmode=False):  # pylint: disable=unused-argument
     """
@@ -44,15 +49,17 @@ def dump_bintext(filebuf, marker, numid, text, comment, binmode=True):  # pylint
 def dump_sequential(filebuf, code_section, imarker, binmode=False):
     """
     Dump records to file object ``filebuf`` without caring for duplicated ones
+    ``imarker`` selects the records dumped (bgi_common.MARKER_* value)
     ``binmode`` must be set accordingly to the file object type
     Returns: None
     """
     writer_fun = dump_bintext if binmode else dump_text
     for addr in sorted(code_section):
-        text, numid, marker, comment = code_section[addr]
-        if marker == imarker:
-            writer_fun(filebuf, marker, numid,
-                       text if binmode else bgi_common.escape(text), comment, binmode)
+        record = code_section[addr]
+        if record.marker == imarker:
+            writer_fun(filebuf, record.get_marker(), record.numid,
+                       record.text if binmode else bgi_common.escape(record.text),
+                       record.get_comment(), binmode)
 
 
 def register_translations(indexedpo, code_dictionary):
@@ -64,9 +71,9 @@ def register_translations(indexedpo, code_dictionary):
     prev_text = None
 
     for addr in sorted(code_dictionary):
-        text, _, marker, comment = code_dictionary[addr]
-       
-        print(code_dictionary[addr])
+        record = code_dictionary[addr]
+        text = record.text
+        marker = record.marker
 
         if text == "_PlayVoice":
             voice = prev_text
@@ -75,9 +82,9 @@ def register_translations(indexedpo, code_dictionary):
 
         prev_text = text
 
-        if marker == 'N':
+        if marker == bgi_common.MARKER_NAME:
             prefillmsg = "NAME:{}".format(bgi_common.escape(text))
-        elif marker == 'Z':
+        elif marker == bgi_common.MARKER_OTHER:
             continue  # not processed here
         else:
             prefillmsg = bgi_common.escape(text) if bgi_setup.dcopy else ''
@@ -93,7 +100,7 @@ def register_translations(indexedpo, code_dictionary):
         indexedpo.add(
             bgi_common.escape(text),
             msgstr=prefillmsg,
-            comment=comment
+            comment=record.get_comment()
         )
         
 def do_extra_diags(scriptpath, code_dictionary, orph_bstrs):
@@ -101,48 +108,59 @@ def do_extra_diags(scriptpath, code_dictionary, orph_bstrs):
     Write extra (debug) files for analysis/diagnostics
     """
     with open(scriptpath + '.Z_strings', 'w', encoding=bgi_setup.denc) as outz:
-        dump_sequential(outz, code_dictionary, 'Z')
+        dump_sequential(outz, code_dictionary, bgi_common.MARKER_OTHER)
     if os.path.getsize(scriptpath + '.Z_strings') == 0:
         os.unlink(scriptpath + '.Z_strings')
     if len(orph_bstrs) > 0:
-        print("{} orphan strings written to separate .orphans file.".format(len(orph_bstrs)),
-              file=sys.stderr)
+        log.info("%d orphan strings written to separate .orphans file.", len(orph_bstrs))
         with open(scriptpath + '.orphans', 'wb') as outo:
             for addr in sorted(orph_bstrs):
                 dump_bintext(outo, None, None, orph_bstrs[addr], "MIS{:04X}".format(addr))
 
 
-def dump_script(scriptpath):
+def dump_script(scriptpath, data=None):
     """
     Open and process a BGI script
     Output a .po localization file in a specific subfolder (automatically created)
+    `data` may hold the script contents as any bytes-like object (e.g. an archive member),
+    `scriptpath` then only names the outputs
+    Emits a 'dump' event with the record counts per marker
     """
     po_ext = 'pot' if len(bgi_setup.dlang) == 1 and bgi_setup.dlang[0] == bgi_setup.slang else 'po'
 
     scriptname = os.path.splitext(os.path.basename(scriptpath))[0]
-    data = open(scriptpath, 'rb').read()
-    _, code_bytes, text_bytes, config = bgi_common.split_data(data)
-    try:
-        state = bgi_common.CodeSectionState()
-        code_section, orph_bstrs = state.get_code_section(code_bytes, text_bytes, config)
-    except bgi_common.BgiCustomException as exc:
-        print(str(exc), file=sys.stderr)
-        sys.exit(1)
-    idxpo = bgi_po.IndexedPo()  # may specify encoding='utf-8-sig' for WinMerge but non-conforming
-    register_translations(idxpo, code_section)
-    # Write po for each destination language
-    bgi_common.makedir('{}/{}'.format(bgi_setup.project_name, scriptname))
-    for lang in bgi_setup.dlang:
-        idxpo.set_language(lang)
-        idxpo.save(fpath='{}/{}/{}.{}'.format(bgi_setup.project_name, scriptname, lang, po_ext))
-    do_extra_diags(scriptpath, code_section, orph_bstrs)
+    with bgi_log.timed('dump', file=scriptpath) as event:
+        if data is None:
+            with open(scriptpath, 'rb') as infile:
+                data = infile.read()
+        event['bytes'] = len(data)
+        script = bgi_script.Script(data, bgi_cache.get_default())
+        try:
+            code_section, orph_bstrs = script.get_code_section()
+        except bgi_common.BgiCustomException as exc:
+            log.error('%s', exc)
+            sys.exit(1)
+        writer = script.make_po()
+        # Write po for each destination language
+        bgi_common.makedir('{}/{}'.format(bgi_setup.project_name, scriptname))
+        for lang in bgi_setup.dlang:
+            writer.set_language(lang)
+            writer.save('{}/{}/{}.{}'.format(bgi_setup.project_name, scriptname, lang, po_ext))
+        do_extra_diags(scriptpath, code_section, orph_bstrs)
+        event['records'] = collections.Counter(record.get_marker()
+                                               for record in code_section.values())
+        event['orphans'] = len(orph_bstrs)
+        event['cached'] = 'po' in script.cached
+        event['entries'] = len(writer)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    args = bgi_log.parse_args(sys.argv[1:])
+    if not args:
         print('Usage: bgi_dumppo.py <file(s)>')
         print('(only extension-less files amongst <file(s)> will be processed)')
+        print(bgi_log.USAGE)
         sys.exit(1)
-    for arg in sys.argv[1:]:
+    for arg in args:
         for script in glob.glob(arg):
             base, ext = os.path.splitext(script)
             if not ext and os.path.isfile(script):
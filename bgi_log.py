@@ -0,0 +1,124 @@
+"""
+Logging and instrumentation shared by the BGI script tools
+
+Messages go to stderr through the standard logging module (logger 'bgi' and its children).
+Structured events can also be appended to a JSON-lines file, one object per line,
+to monitor batch runs without paying for console output.
+
+Usage:
+  args = bgi_log.parse_args(sys.argv[1:])  # applies and strips -q, -v and --events FILE
+  log = bgi_log.get_logger('dumppo')
+  with bgi_log.timed('dump', file=path) as event:
+      event['entries'] = 12                 # emitted with 'seconds' when the block ends
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+LOGGER_NAME = 'bgi'
+
+USAGE = 'Logging options: -q/--quiet, -v/--verbose, --events <JSON-lines file>'
+
+_settings = {'level': logging.INFO, 'events': None}
+_events_fd = None
+
+
+def get_logger(name=None):
+    """
+    Returns: logging.Logger, 'bgi' or one of its children
+    """
+    return logging.getLogger(LOGGER_NAME if name is None else '{}.{}'.format(LOGGER_NAME, name))
+
+
+def setup(level=logging.INFO, events=None):
+    """
+    Print messages from `level` upwards to stderr, and append events to the file `events`
+    Worker processes should call this with the settings of their parent (see get_settings()).
+    """
+    global _events_fd  # pylint: disable=global-statement
+    logger = get_logger()
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+    if _events_fd is not None:
+        os.close(_events_fd)
+        _events_fd = None
+    if events:
+        # single write() calls on an O_APPEND file keep lines whole across processes
+        _events_fd = os.open(events, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+    _settings.update(level=level, events=events)
+
+
+def get_settings():
+    """
+    Returns: tuple (level, events) to pass to setup() in worker processes
+    """
+    return _settings['level'], _settings['events']
+
+
+def emit(event, **fields):
+    """
+    Record a structured event, logged at DEBUG level and written to the events file if any
+    """
+    record = dict(event=event, time=round(time.time(), 3), pid=os.getpid(), **fields)
+    line = json.dumps(record, ensure_ascii=False)
+    get_logger().debug('%s', line)
+    if _events_fd is not None:
+        os.write(_events_fd, (line + '\n').encode('utf-8'))
+
+
+@contextlib.contextmanager
+def timed(event, **fields):
+    """
+    Emit `event` when the block ends, with its duration in 'seconds'
+    The block may add fields to the yielded dict. Failures are recorded in 'error'.
+    """
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as exc:
+        fields['error'] = '{}: {}'.format(type(exc).__name__, exc)
+        raise
+    finally:
+        fields['seconds'] = round(time.perf_counter() - start, 6)
+        emit(event, **fields)
+
+
+def add_arguments(parser):
+    """
+    Add the logging options to an argparse.ArgumentParser (see configure())
+    """
+    group = parser.add_argument_group('logging')
+    group.add_argument('-q', '--quiet', action='store_true',
+                       help='only print warnings and errors')
+    group.add_argument('-v', '--verbose', action='store_true',
+                       help='also print debug messages, including events')
+    group.add_argument('--events', metavar='FILE',
+                       help='append JSON-lines events (per-file timings and counts) to FILE')
+
+
+def configure(args):
+    """
+    Apply the logging options parsed from add_arguments()
+    """
+    level = logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO
+    setup(level, args.events)
+
+
+def parse_args(argv):
+    """
+    Apply the logging options found in `argv`, for tools taking plain file arguments
+    Returns: array of the remaining arguments
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(parser)
+    args, remaining = parser.parse_known_args(argv)
+    configure(args)
+    return remaining
@@ -1,12 +1,123 @@
 """
-bgi_po.IndexedPo class for i18n
+bgi_po.IndexedPo, bgi_po.Catalog and bgi_po.PoWriter classes for i18n
 """
 
+import collections
 import datetime
+import io
+import marshal
+import os
+import textwrap
 import polib
 
+import buriko_common
 
-class IndexedPo(polib.POFile):
+CATALOG_CACHE_VERSION = 1
+CATALOG_CACHE_EXT = '.cache'
+
+
+def get_blank_metadata():
+    """
+    Returns: dict of the metadata of a newly created PO file
+    """
+    try:
+        now = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
+    except AttributeError:
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    return {
+        'Project-Id-Version': 'PACKAGE VERSION',
+        'Report-Msgid-Bugs-To': '',
+        'POT-Creation-Date': now,
+        'PO-Revision-Date': 'YEAR-MO-DA HO:MI+ZONE',
+        'Last-Translator': 'FULL NAME <EMAIL@ADDRESS>',
+        'Language-Team': 'LANGUAGE <LL@li.org>',
+        'MIME-Version': '1.0',
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Transfer-Encoding': '8bit',
+        'X-Generator': 'Bgi_script_tools::IndexedPo',
+    }
+
+
+class IndexedLookups:
+    """
+    Indexed msgid/msgctxt lookups shared by IndexedPo and Catalog
+    Subclasses are iterable over entries and set ``self._indexes = {}``
+    """
+
+    def invalidate_index(self):
+        """
+        Drop lookup indexes. They are rebuilt on the next lookup.
+        Entries are tracked when added or removed, but callers modifying the
+        msgid/msgctxt of entries in place should call this afterwards.
+        """
+        self._indexes = {}
+
+    def _get_index(self, by, prefix):
+        """
+        Build (or reuse) a dict mapping the ``by`` property of entries to a list of entries,
+        in file order. When ``prefix`` is set, the key is the property value up to its first ':'.
+        """
+        key = (by, prefix)
+        index = self._indexes.get(key)
+        if index is None:
+            index = {}
+            for entry in self:
+                value = getattr(entry, by)
+                if prefix:
+                    if value is None:
+                        continue
+                    value = value[:value.find(':') + 1]
+                index.setdefault(value, []).append(entry)
+            self._indexes[key] = index
+        return index
+
+    def find(self, st, by='msgid', include_obsolete_entries=False, msgctxt=False):
+        """
+        Indexed version of polib._BaseFile.find() with the same semantics
+        Lookups by msgid or msgctxt are indexed.
+        """
+        if by in ('msgid', 'msgctxt'):
+            candidates = self._get_index(by, False).get(st, ())
+        else:
+            candidates = self
+        matches = [
+            entry for entry in candidates
+            if getattr(entry, by) == st and
+            (include_obsolete_entries or not entry.obsolete) and
+            (msgctxt is False or entry.msgctxt == msgctxt)
+        ]
+        if len(matches) == 1:
+            return matches[0]
+        if len(matches) > 1 and not msgctxt:
+            # find the entry with no msgctx, or fallback to the first entry found
+            unscoped = [entry for entry in matches if not entry.msgctxt]
+            return unscoped[-1] if unscoped else matches[0]
+        return None  # several entries with the requested msgctxt, as polib does
+
+    def find_by_prefix(self, searchterm, by='msgid'):
+        """
+        Find the entry whose msgid begins with the string ``searchterm``.
+        Lookups of the form '<ID>:' (i.e. the only ':' is last) are indexed.
+        """
+        if by in ('msgid', 'msgctxt') and searchterm.find(':') == len(searchterm) - 1 >= 0:
+            for entry in self._get_index(by, True).get(searchterm, ()):
+                if getattr(entry, by).startswith(searchterm):
+                    return entry
+            return None
+        for entry in self:
+            if getattr(entry, by).startswith(searchterm):
+                return entry
+        return None
+
+    def find_by_id(self, numid, by='msgid'):
+        """
+        Find the entry whose msgid is numbered ``numid`` (written as in the msgid, e.g. '0012')
+        """
+        return self.find_by_prefix("{}:".format(numid), by)
+
+
+class IndexedPo(IndexedLookups, polib.POFile):
     """
     Adds extra methods to polib.POFile
 
@@ -22,6 +133,7 @@ class IndexedPo(polib.POFile):
         """
         See polib._BaseFile.__init__() for details on arguments
         """
+        self._indexes = {}
         super().__init__(*args, **kwargs)
         if self.fpath is None:
             self._init_blank_po()
@@ -30,23 +142,7 @@ class IndexedPo(polib.POFile):
 
     def _init_blank_po(self):
         self.count = 0
-        try:
-            now = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
-        except AttributeError:
-            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-        self.metadata = {
-            'Project-Id-Version': 'PACKAGE VERSION',
-            'Report-Msgid-Bugs-To': '',
-            'POT-Creation-Date': now,
-            'PO-Revision-Date': 'YEAR-MO-DA HO:MI+ZONE',
-            'Last-Translator': 'FULL NAME <EMAIL@ADDRESS>',
-            'Language-Team': 'LANGUAGE <LL@li.org>',
-            'MIME-Version': '1.0',
-            'Content-Type': 'text/plain; charset=utf-8',
-            'Content-Transfer-Encoding': '8bit',
-            'X-Generator': 'Bgi_script_tools::IndexedPo',
-        }
+        self.metadata = get_blank_metadata()
 
     def add(self, msgctxt, **kwargs):
         """
@@ -73,11 +169,208 @@ class IndexedPo(polib.POFile):
         self.metadata['Language-Team'] = '{0} <{0}@li.org>'.format(langid)
         self.metadata['Language'] = '{}'.format(langid)
 
-    def find_by_prefix(self, searchterm, by='msgid'):
+
+def _invalidating(method):
+    """
+    (Internal) Wrap a list mutator of IndexedPo so that it drops lookup indexes
+    """
+    def wrapper(self, *args, **kwargs):
+        self.invalidate_index()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__iadd__'):
+    setattr(IndexedPo, _name, _invalidating(getattr(polib.POFile, _name)))
+
+
+CatalogEntry = collections.namedtuple('CatalogEntry',
+                                      ['msgctxt', 'msgid', 'msgstr', 'comment', 'obsolete'])
+
+
+class Catalog(IndexedLookups):
+    """
+    Read-only PO catalog stored as columns, with the lookups of IndexedPo
+    Use polib (or IndexedPo) to modify and write PO files.
+
+    Usage:
+      catalog = bgi_po.load_catalog(pathstr)
+      entry = catalog.find_by_id('0012')
+    """
+
+    def __init__(self, columns, metadata):
         """
-        Find the entry whose msgid begins with the string ``searchterm``.
+        ``columns`` is a tuple of lists (msgctxt, msgid, msgstr, comment, obsolete)
         """
-        for entry in self:
-            if getattr(entry, by).startswith(searchterm):
-                return entry
-        return None
+        self._indexes = {}
+        self.columns = columns
+        self.metadata = metadata
+
+    @classmethod
+    def from_pofile(cls, pofile):
+        """
+        Build a Catalog from a polib.POFile
+        """
+        columns = tuple([getattr(entry, field) for entry in pofile]
+                        for field in CatalogEntry._fields)
+        return cls(columns, dict(pofile.metadata))
+
+    def __len__(self):
+        return len(self.columns[1])
+
+    def __getitem__(self, idx):
+        return CatalogEntry(*(column[idx] for column in self.columns))
+
+    def __iter__(self):
+        return map(CatalogEntry._make, zip(*self.columns))
+
+
+def _format_field(fieldname, field, wrapwidth):
+    """
+    (Internal) Render a field as polib._BaseEntry._str_field() does for current entries
+    Returns: array of str lines
+    """
+    lines = field.splitlines(True)
+    if len(lines) > 1:
+        lines = [''] + lines  # start with initial empty line
+    else:
+        specialchars_count = sum(field.count(c) for c in '\\\n\r\t\v\b\f"')
+        # fieldname length + one space + 2 quotes (eg. msgid "<string>")
+        real_wrapwidth = wrapwidth - len(fieldname) - 3 + specialchars_count
+        if wrapwidth > 0 and len(field) > real_wrapwidth:
+            lines = [''] + [polib.unescape(item) for item in textwrap.wrap(
+                polib.escape(field),
+                wrapwidth - 2,  # 2 for quotes ""
+                drop_whitespace=False,
+                break_long_words=False
+            )]
+        else:
+            lines = [field]
+    ret = ['%s "%s"' % (fieldname, polib.escape(lines[0]))]
+    ret.extend('"%s"' % polib.escape(line) for line in lines[1:])
+    return ret
+
+
+def format_entry(msgctxt, msgid, msgstr, comment, wrapwidth=78):
+    """
+    Render an entry exactly as polib.POEntry.__unicode__() does, for the fields used here
+    Returns: str
+    """
+    ret = []
+    if comment:
+        for line in comment.split('\n'):
+            if wrapwidth > 0 and len(line) + 3 > wrapwidth:
+                ret += textwrap.wrap(line, wrapwidth, initial_indent='#. ',
+                                     subsequent_indent='#. ', break_long_words=False)
+            else:
+                ret.append('#. ' + line)
+    if msgctxt is not None:
+        ret += _format_field('msgctxt', msgctxt, wrapwidth)
+    ret += _format_field('msgid', msgid, wrapwidth)
+    ret += _format_field('msgstr', msgstr, wrapwidth)
+    ret.append('')
+    return '\n'.join(ret)
+
+
+class PoWriter(Catalog):
+    """
+    Write-only counterpart of IndexedPo.add() + IndexedPo.save(), with the lookups of Catalog
+    Each entry is rendered once when added, so that saving the catalog once per language
+    only renders the header block again. The files are identical to those of polib.
+
+    Usage:
+      writer = bgi_po.PoWriter()
+      writer.add(msgctxt, msgstr=msgstr, comment=comment)
+      for lang in langs:
+          writer.set_language(lang)
+          writer.save(pathstr)
+    """
+
+    def __init__(self, wrapwidth=78, encoding=polib.default_encoding):
+        super().__init__(tuple([] for _ in CatalogEntry._fields), get_blank_metadata())
+        self.wrapwidth = wrapwidth
+        self.encoding = encoding
+        self._body = io.StringIO()
+        self._encoded_body = None
+
+    def add(self, msgctxt, msgstr='', comment=''):
+        """
+        Add a message numbered after the previous ones, as IndexedPo.add() does
+        """
+        msgid = "{:04d}:".format(len(self) + 1)
+        for column, value in zip(self.columns, (msgctxt, msgid, msgstr, comment, False)):
+            column.append(value)
+        self.invalidate_index()
+        self._body.write('\n')
+        self._body.write(format_entry(msgctxt, msgid, msgstr, comment, self.wrapwidth))
+        self._encoded_body = None
+
+    def set_language(self, langid):
+        """
+        Set language headers in the po file metadata
+        """
+        self.metadata['Language-Team'] = '{0} <{0}@li.org>'.format(langid)
+        self.metadata['Language'] = '{}'.format(langid)
+
+    def get_rendered(self):
+        """
+        Returns: tuple (columns, str rendered entries), which set_rendered() restores
+        """
+        return self.columns, self._body.getvalue()
+
+    def set_rendered(self, rendered):
+        """
+        Replace the entries with those saved by get_rendered()
+        """
+        columns, body = rendered
+        self.columns = tuple(list(column) for column in columns)
+        self.invalidate_index()
+        self._body = io.StringIO(body)
+        self._body.seek(0, io.SEEK_END)
+        self._encoded_body = None
+
+    def _get_header(self):
+        header = polib.POFile(wrapwidth=self.wrapwidth, encoding=self.encoding)
+        header.metadata = self.metadata
+        return header.__unicode__()
+
+    def __str__(self):
+        return self._get_header() + self._body.getvalue()
+
+    def save(self, fpath):
+        """
+        Write the catalog to ``fpath``, with platform newlines as polib does
+        """
+        if self._encoded_body is None:
+            self._encoded_body = self._body.getvalue().replace('\n', os.linesep).encode(
+                self.encoding)
+        with open(fpath, 'wb') as pofile:
+            pofile.write(self._get_header().replace('\n', os.linesep).encode(self.encoding))
+            pofile.write(self._encoded_body)
+
+
+def load_catalog(fpath):
+    """
+    Parse a PO file into a Catalog, through a binary sidecar (``fpath`` + '.cache')
+    The sidecar is reused as long as the PO file keeps the same mtime and size.
+    Returns: Catalog
+    """
+    stat = os.stat(fpath)
+    key = (CATALOG_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+    cachepath = fpath + CATALOG_CACHE_EXT
+    try:
+        with open(cachepath, 'rb') as cachefile:
+            cached_key, columns, metadata = marshal.load(cachefile)
+        if cached_key == key:
+            return Catalog(columns, metadata)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    catalog = Catalog.from_pofile(polib.pofile(fpath))
+    try:
+        buriko_common.save_build_file(cachepath, (key, catalog.columns, catalog.metadata))
+    except OSError:
+        pass  # read-only location, the cache is optional
+    return catalog
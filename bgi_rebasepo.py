@@ -3,51 +3,118 @@
 # Reconcile multiple *.po's with a reference .pot file
 # Also rewrite numeric msgid's to a fully-fledged one with original text
 
+import multiprocessing
 import os
+import re
 import sys
 import polib
 
+import bgi_log
 import bgi_po
 import bgi_setup
 
-def rebase_po(source_po):
+log = bgi_log.get_logger('rebasepo')
+
+
+class RebaseError(Exception):
+	"""
+		Raised when a project subfolder cannot be rebased
+	"""
+	pass
+
+
+def rebase_subdir(subdir, source_po):
+	"""
+		rebase all po's of a single project subfolder against its `source_po`
+		Catalogs are written to temporary files first, then renamed over the originals
+		(reference last), so that an interrupted run can be resumed.
+		Returns: list of rebased paths
+	"""
+	refpopath = "{}/{}/{}".format(bgi_setup.project_name, subdir, source_po)
+	if not os.path.exists(refpopath):
+		raise RebaseError(
+			"Error: Missing {}\nYou need to generate the template, having (dlang == slang) "
+			"and (dcopy == True) in bgi_setup.py, and run bgi_dumppo.py once.".format(refpopath))
+	refpot = polib.pofile(refpopath, klass=bgi_po.IndexedPo)
+	tlmap = {}
+	for refent in refpot:
+		tlmap[refent.msgid] = ("{}{}".format(refent.msgid, refent.msgctxt), refent.msgctxt)
+	for key in tlmap:
+		if not re.match(r'\d+:$', key):
+			raise RebaseError(
+				"Error: msgid in {} should be in the format '<NUMBER>:'. "
+				"Make sure you only run this tool once.".format(refpopath))
+		break
+
+	staged = []
+	try:
+		for poname in sorted(os.listdir(os.path.join(bgi_setup.project_name, subdir))):
+			if poname != source_po and poname.endswith(('.po', '.pot')):
+				modpath = "{}/{}/{}".format(bgi_setup.project_name, subdir, poname)
+				modpo = polib.pofile(modpath, klass=bgi_po.IndexedPo)
+				mod_entries = dict((entry.msgid, entry) for entry in modpo if not entry.obsolete)
+				for oldid, newinfo in tlmap.items():
+					e = mod_entries.get(oldid)
+					if e is None:
+						if newinfo[0] in mod_entries:
+							continue  # already rebased by an interrupted run
+						raise RebaseError("Error: msgid '{}' of {} is missing from {}".format(
+							oldid, refpopath, modpath))
+					e.msgid, e.msgctxt = newinfo
+				staged.append(modpath)
+				modpo.save(modpath + '.tmp')
+		ref_entries = dict((entry.msgid, entry) for entry in refpot if not entry.obsolete)
+		for oldid, newinfo in tlmap.items():
+			ref_entries[oldid].msgid, _ = newinfo
+		staged.append(refpopath)
+		refpot.save(refpopath + '.tmp')
+		for path in staged:
+			os.replace(path + '.tmp', path)
+	finally:
+		# catalogs not renamed yet (only on failure): leave no temporary file behind
+		for path in staged:
+			if os.path.exists(path + '.tmp'):
+				os.remove(path + '.tmp')
+	return staged
+
+
+def _rebase_task(task):
+	"""
+		(Worker) rebase_subdir() wrapper reporting errors as values
+		Returns: tuple (list of paths, str error or None)
+	"""
+	try:
+		return rebase_subdir(*task), None
+	except (RebaseError, OSError, IOError) as exc:
+		return [], str(exc)
+
+
+def rebase_po(source_po, jobs=None):
 	"""
 		reconcile multiple po's from several slang by making one of them authoritative
 		- sync all msgid's
 		- overwrite msgctxt
 		- leaves comment untouched
+		Project subfolders are processed in parallel across `jobs` processes (default: CPU count)
 	"""
-	for subdir in [name for name in os.listdir(bgi_setup.project_name)
-	                             if os.path.isdir(os.path.join(bgi_setup.project_name, name))]:
-		refpopath = "{}/{}/{}".format(bgi_setup.project_name, subdir, source_po)
-		print("Ref: {}".format(refpopath), file=sys.stderr)
-		if not os.path.exists(refpopath):
-			print("Error: Missing {}\nYou need to generate the template, having (dlang == slang) and (dcopy == True) in bgi_setup.py, and run bgi_dumppo.py once.".format(refpopath))
-			sys.exit(1)
-		refpot = polib.pofile(refpopath, klass=bgi_po.IndexedPo)
-		tlmap = {}
-		for refent in refpot:
-			tlmap[refent.msgid] = ("{}{}".format(refent.msgid, refent.msgctxt), refent.msgctxt)
-		for key in tlmap:
-			if key[-1] != ":":
-				print("Error: msgid in {} should be in the format '<NUMBER>:'. Make sure you only run this tool once.".format(refpopath), file=sys.stderr)
-				sys.exit(1)
-			break
-		
-		for poname in os.listdir(os.path.join(bgi_setup.project_name, subdir)):
-			if poname != source_po:
-				modpath = "{}/{}/{}".format(bgi_setup.project_name, subdir, poname)
-				print("Po: {}".format(modpath), file=sys.stderr)
-				modpo = polib.pofile(modpath, klass=bgi_po.IndexedPo)
-				mod_entries = dict((entry.msgid, entry) for entry in modpo)
-				for oldid,newinfo in tlmap.items():
-					e = modpo.find(oldid)
-					e.msgid, e.msgctxt = newinfo
-				modpo.save()
-		for oldid,newinfo in tlmap.items():
-			refpot.find(oldid).msgid, _ = newinfo
-		refpot.save()
+	subdirs = [name for name in sorted(os.listdir(bgi_setup.project_name))
+		if os.path.isdir(os.path.join(bgi_setup.project_name, name)) and
+		name != 'compiled' and not name.startswith('.')]
+	failed = False
+	with bgi_log.timed('rebase', source=source_po, subdirs=len(subdirs)) as event:
+		with multiprocessing.Pool(jobs) as pool:
+			tasks = [(subdir, source_po) for subdir in subdirs]
+			for paths, error in pool.imap_unordered(_rebase_task, tasks):
+				if error:
+					log.error("%s", error)
+					failed = True
+				for path in paths:
+					log.info("Rebased: %s", path)
+		event['failed'] = failed
+	if failed:
+		sys.exit(1)
 
 if __name__ == '__main__':
-	print("Source lang: {}".format(bgi_setup.slang), file=sys.stderr)
+	bgi_log.parse_args(sys.argv[1:])
+	log.info("Source lang: %s", bgi_setup.slang)
 	rebase_po("{}.pot".format(bgi_setup.slang))
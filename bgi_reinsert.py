@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Reinserts PO translations into original BGI scripts, without .bsd files
+
+The string operands of each script are patched in a copy of its code from a relocation
+table (derived once, then kept in the decode cache, see bgi_script.Script.get_relocations()),
+and only the text section is rebuilt. The output is the same as bgidis then bgias, as long
+as the .bsd files were not edited by hand: use bgias for those.
+"""
+import glob
+import os
+import sys
+
+import bgi_cache
+import bgi_log
+import bgi_po
+import bgi_script
+import buriko_common
+import buriko_setup
+
+
+def reinsert_script(scriptpath, data=None):
+    """
+    Recompile an original BGI script with the translations of its .po file
+    (same paths as bgias: project/<script>/<ilang>.po to project/compiled/<script>)
+    `data` may hold the script contents as any bytes-like object (e.g. an archive member),
+    `scriptpath` then only names the outputs
+    Emits a 'reinsert' event
+    """
+    scriptname = os.path.splitext(os.path.basename(scriptpath))[0]
+    buriko_common.makedir('{}/compiled'.format(buriko_setup.project_name))
+    ofilepath = '{}/compiled/{}'.format(buriko_setup.project_name, scriptname)
+    in_popath = '{}/{}/{}.po'.format(buriko_setup.project_name, scriptname, buriko_setup.ilang)
+
+    with bgi_log.timed('reinsert', file=scriptpath) as event:
+        if data is None:
+            with open(scriptpath, 'rb') as infile:
+                data = infile.read()
+        script = bgi_script.Script(data, bgi_cache.get_default())
+        compiled = script.reinsert(bgi_po.load_catalog(in_popath))
+
+        with open(ofilepath, 'wb') as outfile:
+            outfile.write(compiled)
+        event['bytes'] = len(compiled)
+        event['cached'] = 'relocs' in script.cached
+
+
+if __name__ == '__main__':
+    args = bgi_log.parse_args(sys.argv[1:])
+    if not args:
+        print('Usage: bgi_reinsert.py <file(s)>')
+        print('(only extension-less files amongst <file(s)> will be processed)')
+        print(bgi_log.USAGE)
+        sys.exit(1)
+    for arg in args:
+        for script in glob.glob(arg):
+            base, ext = os.path.splitext(script)
+            if not ext and os.path.isfile(script):
+                reinsert_script(script)
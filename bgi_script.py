@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+In-memory BGI script pipeline: original bytes -> PO catalog / .bsd -> recompiled bytes
+The file-based tools (bgi_dumppo, bgidis, bgias) are wrappers around this module.
+
+Usage:
+  script = bgi_script.Script(data)       # or Script(data, bgi_cache.get_default())
+  po = script.make_po()                 # what bgi_dumppo writes
+  bsd = script.disassemble()            # what bgidis writes
+  bsb = script.disassemble_binary()     # what bgidis writes as .bsb
+  compiled = script.assemble(po)        # what bgias writes, from the above
+  compiled = script.reinsert(po)        # same, patching the original code instead
+"""
+import glob
+import io
+import os
+import struct
+import sys
+
+import asdis
+import bgi_bsb
+import bgi_common
+import bgi_config
+import bgi_dumppo
+import bgi_log
+import bgi_po
+import bgias
+import bgidis
+import bgiop
+import buriko_common
+import buriko_setup
+
+
+class Script:
+    """
+    A BGI script held in memory, decoded once (on first use) and shared by all stages
+    With a bgi_cache.DecodeCache, results of get_code_section(), make_po(), disassemble(),
+    disassemble_binary() and get_relocations() are looked up in the cache before decoding
+    anything.
+    Properties:
+      data: original script contents (any bytes-like object)
+      hdr_bytes, code_bytes, text_bytes, config: see bgi_common.split_data()
+        (the section layout is cached as well), sections being memoryviews of `data`
+      instrs: decoded bgiop.Instructions, or None if the bytecode uses unknown opcodes
+      cached: set of the stages served from the cache
+    """
+
+    def __init__(self, data, cache=None):
+        self.data = data
+        self.cache = cache
+        self.cached = set()
+        self._digest = None
+        self._decoded = False
+        self._instrs = None
+        self._decode_error = None
+        self._code_section = None
+        hdr_size, boundary = self._get_cached('layout', self._get_layout)
+        self.config = bgi_config.get_config(data)
+        view = memoryview(data)
+        self.hdr_bytes = view[:hdr_size]
+        self.code_bytes = view[hdr_size:boundary]
+        self.text_bytes = view[boundary:]
+
+    def _get_layout(self):
+        """
+        (Internal) Locate the sections, keeping the instructions decoded on the way
+        Returns: tuple (int header size, int boundary), see bgi_common.get_code_layout()
+        """
+        hdr_size, boundary, instrs = bgi_common.get_code_layout(self.data)
+        if instrs is not None:
+            self._instrs = instrs
+            self._decoded = True
+        return hdr_size, boundary
+
+    def _decode(self):
+        if not self._decoded:
+            try:
+                self._instrs = bgiop.decode(self.get_code(), len(self.code_bytes))
+            except asdis.InvalidBytecode as exc:
+                self._decode_error = exc
+            self._decoded = True
+
+    @property
+    def instrs(self):
+        self._decode()
+        return self._instrs
+
+    @property
+    def decode_error(self):
+        self._decode()
+        return self._decode_error
+
+    def _get_cached(self, stage, compute):
+        """
+        (Internal) Return the cached result of `stage`, or compute and cache it
+        """
+        if self.cache is None:
+            return compute()
+        if self._digest is None:
+            self._digest = buriko_common.get_digest(self.data)
+        key = self.cache.get_key(self._digest, stage)
+        value = self.cache.load(key)
+        if value is None:
+            value = compute()
+            self.cache.store(key, value)
+        else:
+            self.cached.add(stage)
+        return value
+
+    def get_code(self):
+        """
+        Returns: memoryview of the code section followed by the text section
+        """
+        return memoryview(self.data)[len(self.hdr_bytes):]
+
+    def get_code_section(self):
+        """
+        See bgi_common.CodeSectionState.get_code_section(), computed (or loaded) once
+        Returns: tuple (dict {offset: bgi_common.Record}, dict {offset: bytes})
+        """
+        if self._code_section is not None:
+            return self._code_section
+
+        def compute():
+            state = bgi_common.CodeSectionState()
+            code_section, orphans = state.get_code_section(
+                self.code_bytes, self.text_bytes, self.config, self.instrs)
+            return {pos: record.to_tuple() for pos, record in code_section.items()}, orphans
+        records, orphans = self._get_cached('records', compute)
+        self._code_section = (
+            {pos: bgi_common.Record.from_tuple(values) for pos, values in records.items()},
+            orphans)
+        return self._code_section
+
+    def make_po(self):
+        """
+        Build the PO catalog of the script, as bgi_dumppo does
+        Returns: bgi_po.PoWriter
+        """
+        def compute():
+            writer = bgi_po.PoWriter()
+            bgi_dumppo.register_translations(writer, self.get_code_section()[0])
+            return writer.get_rendered()
+        # may specify encoding='utf-8-sig' for WinMerge but non-conforming
+        writer = bgi_po.PoWriter()
+        writer.set_rendered(self._get_cached('po', compute))
+        return writer
+
+    def disassemble(self):
+        """
+        Disassemble the script, as bgidis does
+        Returns: str (.bsd contents)
+        """
+        def compute():
+            if self.instrs is None:
+                raise self.decode_error
+            inst, offsets, hdrtext, defines = bgidis.parse(self.get_code(),
+                                                           bytes(self.hdr_bytes), self.instrs)
+            bsd = io.StringIO()
+            bgidis.out(bsd, inst, offsets, hdrtext, defines)
+            return bsd.getvalue()
+        return self._get_cached('dis', compute)
+
+    def disassemble_binary(self):
+        """
+        Disassemble the script to the binary intermediate, as bgidis does with
+        buriko_setup.intermediate = 'bsb'
+        Returns: bytes (.bsb contents)
+        """
+        def compute():
+            if self.instrs is None:
+                raise self.decode_error
+            return bgi_bsb.from_instrs(*bgidis.parse(self.get_code(), bytes(self.hdr_bytes),
+                                                     self.instrs))
+        return self._get_cached('bsb', compute)
+
+    def assemble(self, inputpo=None, bsd=None):
+        """
+        Recompile the script, as bgias does
+        `inputpo` holds the translations (original text is kept when None)
+        `bsd` may hold an already disassembled (or edited) .bsd
+        Returns: bytes
+        """
+        if inputpo is None:
+            inputpo = bgi_po.IndexedPo()
+        if bsd is None:
+            bsd = self.disassemble()
+        return bgias.assemble(bgias.parse_bsd(bsd), inputpo)
+
+    def get_relocations(self):
+        """
+        Relocation table of the strings referenced by the code section, for reinsert()
+        Returns: tuple of arrays, one item per reference in code order:
+          offsets of the operands in the code section,
+          offsets of the original strings (from the start of the code section),
+          MSGID numbers of push_string operands as in the .bsd (0 for other references)
+        """
+        def compute():
+            if self.instrs is None:
+                raise self.decode_error
+            operands = []
+            addresses = []
+            msgids = []
+            msgid = 0
+            instrs = self.instrs
+            for addr, opcode, arg in zip(instrs.addrs, instrs.opcodes, instrs.args):
+                if opcode in bgiop.text_ops:
+                    operands.append(addr + 4)
+                    addresses.append(arg)
+                    if bgiop.ops[opcode][2] == bgiop.get_string:
+                        msgid += 1
+                        msgids.append(msgid)
+                    else:
+                        msgids.append(0)
+            return operands, addresses, msgids
+        return self._get_cached('relocs', compute)
+
+    def _get_original_text(self, address):
+        """
+        (Internal) Original string at `address` of the code section, as bgias would encode
+        it back from the .bsd
+        Returns: bytes
+        """
+        text = buriko_common.read_cstring(self.get_code(), address)
+        text = buriko_common.get_escaped_text(text).decode(buriko_setup.senc)
+        return buriko_common.encode_text(text)
+
+    def reinsert(self, inputpo):
+        """
+        Recompile the script with the translations of `inputpo` without disassembling it:
+        the text section is rebuilt and the string operands (see get_relocations())
+        are patched in a copy of the original header and code sections.
+        Same output as assemble(inputpo).
+        Returns: bytes
+        """
+        operands, addresses, msgids = self.get_relocations()
+        originals = {}
+        itexts = []
+        for address, msgid in zip(addresses, msgids):
+            itext = None
+            if msgid:
+                ent = inputpo.find_by_id('{:04d}'.format(msgid))
+                if ent is not None and ent.msgstr != "" and not ent.msgstr.startswith("NAME:"):
+                    itext = buriko_common.encode_text(asdis.unescape(ent.msgstr))
+            if itext is None:
+                itext = originals.get(address)
+                if itext is None:
+                    itext = originals[address] = self._get_original_text(address)
+            itexts.append(itext)
+        hdr_size = len(self.hdr_bytes)
+        code_size = len(self.code_bytes)
+        offsets, bintexts = bgias.layout_texts(itexts, code_size)
+        compiled = bytearray(self.data[:hdr_size + code_size])
+        pack_into = struct.Struct('<I').pack_into
+        for operand, offset in zip(operands, offsets):
+            pack_into(compiled, hdr_size + operand, offset)
+        for bintext in bintexts:
+            compiled += bintext
+            compiled.append(0)
+        return bytes(compiled)
+
+    def _get_masked_code(self):
+        """
+        (Internal) Code section with its string operands zeroed, and the strings they reference
+        Returns: tuple (bytearray, array of bytes)
+        """
+        operands, addresses, _ = self.get_relocations()
+        code = bytearray(self.code_bytes)
+        strings = []
+        for operand, address in zip(operands, addresses):
+            code[operand:operand + 4] = b'\x00\x00\x00\x00'
+            strings.append(buriko_common.read_cstring(self.get_code(), address))
+        return code, strings
+
+    def roundtrip(self):
+        """
+        Check that disassembling then assembling without translations gives back the original
+        header and code sections, each string operand referencing the same string.
+        The text section itself is not compared: the original compiler lays it out in an
+        order that the code does not tell, and may keep strings that nothing references.
+        Returns: Boolean
+        """
+        rebuilt = Script(self.assemble())
+        return (bytes(rebuilt.hdr_bytes) == bytes(self.hdr_bytes) and
+                rebuilt._get_masked_code() == self._get_masked_code())
+
+
+if __name__ == '__main__':
+    args = bgi_log.parse_args(sys.argv[1:])
+    if not args:
+        print('Usage: bgi_script.py <file(s)>')
+        print('Checks in memory that dis -> as reproduces the code of the original scripts')
+        print('(header and code sections, and the strings they reference; see Script.roundtrip())')
+        print('(only extension-less files amongst <file(s)> will be processed)')
+        print(bgi_log.USAGE)
+        sys.exit(1)
+    mismatches = 0
+    for arg in args:
+        for scriptpath in glob.glob(arg):
+            _, ext = os.path.splitext(scriptpath)
+            if not ext and os.path.isfile(scriptpath):
+                with bgi_log.timed('roundtrip', file=scriptpath) as event:
+                    with open(scriptpath, 'rb') as infile:
+                        script = Script(infile.read())
+                    try:
+                        status = 'ok' if script.roundtrip() else 'MISMATCH'
+                    except Exception as exc:  # pylint: disable=broad-except
+                        status = 'ERROR {}'.format(exc)
+                    event['status'] = status
+                if status != 'ok':
+                    mismatches += 1
+                print('{}: {}'.format(scriptpath, status))
+    sys.exit(1 if mismatches else 0)
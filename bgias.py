@@ -3,118 +3,242 @@
 BGI script file assembler
 """
 
+import array
 import glob
+import io
 import os
 import struct
 import sys
-import polib
 
 import buriko_common
+import bgi_bsb
+import bgi_cache
+import bgi_log
 import bgi_po
 import buriko_setup
 
 import asdis
 import bgiop
 
+# modules whose code affects compiled scripts (see get_manifest())
+TOOL_MODULES = ('asdis', 'bgi_bsb', 'bgi_po', 'bgiop', 'buriko_common', 'bgias')
 
-def parse_instr(line, linenum, inputpo):
+
+def resolve_instr(fcn, args, inputpo):
     """
-    Parse a line from a .bsd file and transform it into structured data
-    using given .po resources
-    Returns: tuple (str, array, set)
+    Substitute .po resources in the arguments of an instruction from parse_bsd()
+    Returns: tuple (array, set)
     """
     strings = []
-    fcn, argstr = asdis.re_instr.match(line).groups()
-    argstr = argstr.strip()
-    if argstr:
-        argstr = argstr.replace('\\\\', asdis.backslash_replace).replace('\\"', asdis.quote_replace)
-        quotes = asdis.get_quotes(argstr)
-        if len(quotes) % 2 != 0:
-            raise asdis.QuoteMismatch('Mismatched quotes @ line %d' % linenum)
-        argstr = asdis.replace_quote_commas(argstr, quotes)
-        args = [
-            x
-            .strip()
-            .replace(asdis.comma_replace, ',')
-            .replace(asdis.quote_replace, '\\"')
-            .replace(asdis.backslash_replace, '\\\\')
-            for x in argstr.split(',')
-        ]
+    if args:
+        args = list(args)
         string_to_add = None
         for arg in args:
-            if arg and arg[0] == '"' and arg[-1] == '"':
+            if arg[0] == asdis.TOKEN_STRING:
                 string_to_add = arg
         if fcn == 'push_string':
-            if args[0].startswith('MSGID::'):
-                msgid = args[0][7:]
-                ent = inputpo.find_by_prefix("{}:".format(msgid))
+            if args[0][0] == asdis.TOKEN_MSGID:
+                ent = inputpo.find_by_id(args[0][1])
                 if (
                         ent is not None and
                         ent.msgstr != "" and
                         not ent.msgstr.startswith("NAME:")
                 ):
-                    args[1] = '"{}"'.format(ent.msgstr)
+                    args[1] = (asdis.TOKEN_STRING, asdis.unescape(ent.msgstr))
                 del args[0]
                 string_to_add = args[0]
         if string_to_add is not None:
             strings.append(string_to_add)
-    else:
-        args = []
-    return fcn, args, strings
+    return args, strings
 
 
-def parse(asmtxt, inputpo):
+def parse_bsd(asmtxt):
     """
-    Parse the .bsd disassembly into structured data using given .po resources
-    Returns: tuple(array of lists, dict, array of bytes, bytes, dict)
-    - instrs: list is (fcn:str, args:array, pos:integer, index:integer)
-    - symbols: dict { str: integer } for labels and resources
-    - bintexts: strings in text section, encoded
+    Parse the .bsd disassembly into structured data, regardless of .po resources
+    Returns: tuple(array of lists, dict, integer, str, dict)
+    - instrs: list is (fcn:str, args:array, pos:integer, index:integer),
+      args being tokens (kind:int, value), see asdis.parse_args()
+    - labels: dict { str: integer }
+    - codesize: size of the code section
     - hdrtext: header identifier
     - defines: metadata defined in bsd header
     """
     instrs = []
-    symbols = {}
-    texts = []
+    labels = {}
     pos = 0
     hdrtext = None
     defines = {}
-    for lineidx, line in enumerate(asmtxt.split('\n')):
-        line = line.strip()
-        line = asdis.remove_comment(line)
-        if not line:
-            continue
-        if asdis.re_header.match(line):
-            hdrtext, = asdis.re_header.match(line).groups()
-            hdrtext = asdis.unescape(hdrtext)
-        elif asdis.re_define.match(line):
-            name, offset_s = asdis.re_define.match(line).groups()
-            defines[name] = offset_s
-        elif asdis.re_label.match(line):
-            symbol, = asdis.re_label.match(line).groups()
-            symbols[symbol] = pos
-        elif asdis.re_instr.match(line):
-            fcn, args, strings = parse_instr(line, lineidx + 1, inputpo)
-            record = fcn, args, pos, lineidx + 1
-            texts.extend(strings)
+    for linenum, kind, name, args in asdis.parse_lines(asmtxt):
+        if kind == asdis.LINE_INSTR:
+            record = name, args, pos, linenum
             instrs.append(record)
             try:
-                opcode = bgiop.rops[fcn]
+                opcode = bgiop.rops[name]
             except KeyError:
-                raise asdis.InvalidFunction('Invalid function @ line %d' % (lineidx + 1))
-            pos += struct.calcsize(bgiop.ops[opcode][0]) + 4
+                raise asdis.InvalidFunction('Invalid function @ line %d' % linenum)
+            pos += bgiop.sizes[opcode]
+        elif kind == asdis.LINE_LABEL:
+            labels[name] = pos
+        elif (name == 'header' and len(args) == 1 and args[0][0] == asdis.TOKEN_STRING):
+            hdrtext = args[0][1]
+        elif (name == 'define' and len(args) == 2 and
+              args[0][0] != asdis.TOKEN_STRING and args[1][0] != asdis.TOKEN_STRING):
+            defines[args[0][1]] = args[1][1]
         else:
             raise asdis.InvalidInstructionFormat(
-                'Invalid instruction format @ line {:d}'.format(lineidx + 1))
+                'Invalid instruction format @ line {:d}'.format(linenum))
+    return instrs, labels, pos, hdrtext, defines
+
+
+def layout_texts(itexts, pos):
+    """
+    Lay out encoded strings in a text section starting at offset `pos`
+    With buriko_setup.pool_strings, identical strings are written once, in order of
+    first use; otherwise each one gets a copy, all uses referencing the last one.
+    Returns: tuple (array of int offset of each string, array of bytes strings to write)
+    """
+    placed = {}
+    offsets = []
     bintexts = []
-    for text in texts:
-        symbols[text] = pos
-        text = asdis.unescape(text[1:-1])
-        itext = text.encode(buriko_setup.ienc)
-        itext = buriko_common.unescape_private_sequence(itext)
+    for itext in itexts:
+        if buriko_setup.pool_strings and itext in placed:
+            offsets.append(placed[itext])
+            continue
+        placed[itext] = pos
+        offsets.append(pos)
         bintexts.append(itext)
         pos += len(itext) + 1
-    return instrs, symbols, bintexts, hdrtext, defines
+    if not buriko_setup.pool_strings:
+        offsets = [placed[itext] for itext in itexts]
+    return offsets, bintexts
+
+
+def link(parsed, inputpo):
+    """
+    Complete data from parse_bsd() using given .po resources, and lay out the text section
+    Instructions are resolved to the dwords of the code section in a single pass,
+    string offsets being filled in once the text section is laid out (see layout_texts()).
+    Returns: same as parse()
+    """
+    bsd_instrs, labels, pos, hdrtext, defines = parsed
+    symbols = dict(labels)
+    code = array.array('i')
+    add = code.append
+    rops = bgiop.rops
+    texts = []
+    string_refs = []  # (index in code, string token)
+    for fcn, args, _, linenum in bsd_instrs:
+        add(rops[fcn])
+        if not args:
+            continue
+        if args[0][0] == asdis.TOKEN_MSGID:
+            args, _ = resolve_instr(fcn, args, inputpo)
+        string_to_add = None
+        for arg in args:
+            kind, value = arg
+            if kind == asdis.TOKEN_INT or kind == asdis.TOKEN_HEX:
+                add(value)
+            elif kind == asdis.TOKEN_SYMBOL and value in labels:
+                add(labels[value])
+            elif kind == asdis.TOKEN_STRING:
+                string_refs.append((len(code), arg))
+                add(0)
+                string_to_add = arg
+            else:
+                raise asdis.InvalidInstructionFormat(
+                    'Undefined symbol {} @ line {:d}'.format(value, linenum))
+        if string_to_add is not None:
+            texts.append(string_to_add)
+    bintexts = link_texts(code, symbols, texts, string_refs, pos)
+    return code, symbols, bintexts, hdrtext, defines
+
+
+def link_texts(code, symbols, texts, string_refs, pos):
+    """
+    Lay out the text section after the `pos` bytes of the code section, adding the
+    offset of each string token of `texts` to `symbols`, and fill in the string
+    references of `code` (list of (index in code, string token))
+    Returns: array of bytes strings to write, see layout_texts()
+    """
+    encoded = {}
+    for text in texts:
+        if text not in encoded:
+            encoded[text] = buriko_common.encode_text(text[1])
+    offsets, bintexts = layout_texts([encoded[text] for text in texts], pos)
+    symbols.update(zip(texts, offsets))
+    for idx, text in string_refs:
+        code[idx] = symbols[text]
+    return bintexts
+
+
+def link_bsb(bsb, inputpo):
+    """
+    Same as link(), from a binary intermediate (bgi_bsb.Bsb) instead of parse_bsd() data
+    Returns: same as parse()
+    """
+    labels = bsb.labels
+    symbols = dict(labels)
+    strings = bsb.strings
+    kinds = bsb.kinds
+    bsb_args = bsb.args
+    code = array.array('i')
+    add = code.append
+    push_string = bgiop.rops['push_string']
+    texts = []
+    string_refs = []  # (index in code, string token)
+    idx = 0
+    for instr, (opcode, count) in enumerate(zip(bsb.opcodes, bsb.counts)):
+        add(opcode)
+        if not count:
+            continue
+        kind = kinds[idx]
+        if count == 1 and (kind == asdis.TOKEN_INT or kind == asdis.TOKEN_HEX):
+            add(bsb_args[idx])  # most instructions: a single number
+            idx += 1
+            continue
+        end = idx + count
+        translation = None
+        if kinds[idx] == asdis.TOKEN_MSGID and opcode == push_string:
+            ent = inputpo.find_by_id(strings[bsb_args[idx]])
+            if ent is not None and ent.msgstr != "" and not ent.msgstr.startswith("NAME:"):
+                translation = (asdis.TOKEN_STRING, asdis.unescape(ent.msgstr))
+            idx += 1
+        string_to_add = None
+        for argidx in range(idx, end):
+            kind = kinds[argidx]
+            value = bsb_args[argidx]
+            if kind == asdis.TOKEN_INT or kind == asdis.TOKEN_HEX:
+                add(value)
+            elif kind == asdis.TOKEN_SYMBOL and strings[value] in labels:
+                add(labels[strings[value]])
+            elif kind == asdis.TOKEN_STRING:
+                if translation is not None and string_to_add is None:
+                    string_to_add = translation
+                else:
+                    string_to_add = (kind, strings[value])
+                string_refs.append((len(code), string_to_add))
+                add(0)
+            else:
+                raise asdis.InvalidInstructionFormat('Undefined symbol {} @ instruction {:d}'
+                                                     .format(strings[value], instr + 1))
+        idx = end
+        if string_to_add is not None:
+            texts.append(string_to_add)
+    bintexts = link_texts(code, symbols, texts, string_refs, bsb.codesize)
+    return code, symbols, bintexts, bsb.hdrtext, bsb.defines
+
+
+def parse(asmtxt, inputpo):
+    """
+    Parse the .bsd disassembly into structured data using given .po resources
+    Returns: tuple(array, dict, array of bytes, bytes, dict)
+    - code: array.array('i'), dwords of the code section (opcodes and resolved arguments)
+    - symbols: dict { str: integer } for labels, { string token: integer } for resources
+    - bintexts: strings in text section, encoded
+    - hdrtext: header identifier
+    - defines: metadata defined in bsd header
+    """
+    return link(parse_bsd(asmtxt), inputpo)
 
 
 def out_hdr(asmoutfile, hdrtext, defines, symbols):
@@ -135,53 +259,173 @@ def out_hdr(asmoutfile, hdrtext, defines, symbols):
     asmoutfile.write(b'\x00' * padding)
 
 
-def out(asmoutfile, instrs, symbols, bintexts, hdrtext, defines):
+def build(code, symbols, bintexts, hdrtext, defines):
     """
-    Write to a binary file buffer `asmoutfile` using data gathered from parse()
+    Lay out a compiled script from data gathered from parse(), in a buffer allocated
+    once to its final size
+    Returns: bytearray
     """
+    hdrbuf = io.BytesIO()
     if hdrtext:
-        out_hdr(asmoutfile, hdrtext, defines, symbols)
-    for fcn, args, _, _ in instrs:
-        opcode = bgiop.rops[fcn]
-        asmoutfile.write(struct.pack('<I', opcode))
-        for arg in args:
-            if arg in symbols:
-                asmoutfile.write(struct.pack('<I', symbols[arg]))
-            elif arg.startswith('0x') or arg.startswith('-0x'):
-                asmoutfile.write(struct.pack('<i', int(arg, 16)))
-            elif arg:
-                asmoutfile.write(struct.pack('<i', int(arg)))
+        out_hdr(hdrbuf, hdrtext, defines, symbols)
+    hdr = hdrbuf.getvalue()
+    if sys.byteorder != 'little':
+        code = array.array('i', code)
+        code.byteswap()
+    code_end = len(hdr) + len(code) * code.itemsize
+    buf = bytearray(code_end + sum(len(bintext) + 1 for bintext in bintexts))
+    buf[:len(hdr)] = hdr
+    memoryview(buf)[len(hdr):code_end] = memoryview(code).cast('B')
+    pos = code_end
     for bintext in bintexts:
-        asmoutfile.write(bintext + b'\x00')
+        buf[pos:pos + len(bintext)] = bintext  # NUL terminators are already there
+        pos += len(bintext) + 1
+    return buf
+
+
+def out(asmoutfile, code, symbols, bintexts, hdrtext, defines):
+    """
+    Write to a binary file buffer `asmoutfile` using data gathered from parse(),
+    in a single write
+    """
+    asmoutfile.write(build(code, symbols, bintexts, hdrtext, defines))
+
+
+def assemble(parsed, inputpo):
+    """
+    Compile data from parse_bsd() using given .po resources, in memory
+    Returns: bytes
+    """
+    return bytes(build(*link(parsed, inputpo)))
+
+
+def select_inputs(paths):
+    """
+    Keep one input per script among .bsd and .bsb `paths` (both compile to the same output):
+    the most recently modified, so that a .bsd converted from a .bsb (see bgi_bsb) then
+    edited is the one assembled, or the buriko_setup.intermediate format on a tie
+    Other paths are logged as skipped.
+    Returns: array of str, in the order of `paths`
+    """
+    selected = {}
+    for path in paths:
+        key = os.path.splitext(path)[0]
+        rank = (os.path.getmtime(path),
+                os.path.splitext(path)[1] == '.' + buriko_setup.intermediate)
+        if key not in selected or rank > selected[key][0]:
+            selected[key] = (rank, path)
+    chosen = {path for _, path in selected.values()}
+    for path in paths:
+        if path not in chosen:
+            bgi_log.get_logger('as').warning('skipping: %s (%s is newer)', path,
+                                             selected[os.path.splitext(path)[0]][1])
+    return [path for path in paths if path in chosen]
+
+
+def get_manifest(asmdata, pobytes):
+    """
+    Build manifest of a script: digests of its .bsd (or .bsb) and .po contents, of the
+    insertion settings and of the tools
+    Returns: dict
+    """
+    return {
+        'bsd': buriko_common.get_digest(asmdata),
+        'po': buriko_common.get_digest(pobytes),
+        'settings': buriko_common.get_digest(repr((buriko_setup.senc, buriko_setup.ilang,
+                                                   buriko_setup.ienc,
+                                                   buriko_setup.pool_strings)).encode('utf-8')),
+        'tool': bgi_cache.get_tool_digest(TOOL_MODULES),
+    }
+
+
+def is_up_to_date(manifest, ofilepath, manifestpath):
+    """
+    Check the previous build of a script against its current build manifest
+    Returns: Boolean
+    """
+    if not (buriko_setup.incremental and os.path.isfile(ofilepath)):
+        return False
+    prev_manifest = buriko_common.load_build_file(manifestpath)
+    if prev_manifest is None:
+        return False
+    with open(ofilepath, 'rb') as prev_output:
+        output_digest = buriko_common.get_digest(prev_output.read())
+    return prev_manifest == dict(manifest, output=output_digest)
 
 
 def asm(asmpath):
     """
-    Assemble a BGI script file from .bsd and .po resources
+    Assemble a BGI script file from .bsd (or memory-mapped .bsb, see bgi_bsb) and .po resources
+    With buriko_setup.incremental, the script is skipped when its inputs, the
+    insertion settings and the tools did not change since the last build.
+    Emits an 'as' event
+    Returns: True if the script was assembled, False if skipped
     """
-    buriko_common.makedir('{}/compiled'.format(buriko_setup.project_name))
-    scriptname = os.path.splitext(os.path.basename(asmpath))[0]
-    ofilepath = '{}/compiled/{}'.format(buriko_setup.project_name, scriptname)
-    in_popath = "{}/{}/{}.po".format(buriko_setup.project_name, scriptname, buriko_setup.ilang)
-    in_po = polib.pofile(in_popath, klass=bgi_po.IndexedPo)
-    asmtxt = open(asmpath, 'r', encoding='utf-8-sig').read()
+    with bgi_log.timed('as', file=asmpath, skipped=False) as event:
+        builddir = '{}/compiled/.build'.format(buriko_setup.project_name)
+        buriko_common.makedir(builddir)
+        scriptname, ext = os.path.splitext(os.path.basename(asmpath))
+        ofilepath = '{}/compiled/{}'.format(buriko_setup.project_name, scriptname)
+        in_popath = "{}/{}/{}.po".format(buriko_setup.project_name, scriptname,
+                                         buriko_setup.ilang)
+        manifestpath = '{}/{}.manifest'.format(builddir, scriptname)
+        bsdcachepath = '{}/{}.bsd.cache'.format(builddir, scriptname)
+
+        with open(in_popath, 'rb') as pofile:
+            pobytes = pofile.read()
+        if ext == '.bsb':
+            with bgi_bsb.load(asmpath) as bsb:
+                manifest = get_manifest(bsb.data, pobytes)
+                if is_up_to_date(manifest, ofilepath, manifestpath):
+                    event['skipped'] = True
+                    return False
+                in_po = bgi_po.load_catalog(in_popath)
+                compiled = bytes(build(*link_bsb(bsb, in_po)))
+        else:
+            with open(asmpath, 'rb') as asmfile:
+                asmbytes = asmfile.read()
+            manifest = get_manifest(asmbytes, pobytes)
+            if is_up_to_date(manifest, ofilepath, manifestpath):
+                event['skipped'] = True
+                return False
 
-    instrs, symbols, texts, hdrtext, defines = parse(asmtxt, in_po)
+            bsdcache = (buriko_common.load_build_file(bsdcachepath)
+                        if buriko_setup.incremental else None)
+            if (bsdcache is not None and
+                    bsdcache[0] == manifest['bsd'] and bsdcache[1] == manifest['tool']):
+                parsed = bsdcache[2]
+            else:
+                asmtxt = asmbytes.decode('utf-8-sig').replace('\r\n', '\n').replace('\r', '\n')
+                parsed = parse_bsd(asmtxt)
+                if buriko_setup.incremental:
+                    buriko_common.save_build_file(bsdcachepath,
+                                                  (manifest['bsd'], manifest['tool'], parsed))
+            in_po = bgi_po.load_catalog(in_popath)
+            compiled = assemble(parsed, in_po)
 
-    with open(ofilepath, 'wb') as asmfile:
-        out(asmfile, instrs, symbols, texts, hdrtext, defines)
+        with open(ofilepath, 'wb') as asmfile:
+            asmfile.write(compiled)
+        buriko_common.save_build_file(manifestpath,
+                                      dict(manifest, output=buriko_common.get_digest(compiled)))
+        event['bytes'] = len(compiled)
+        return True
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    args = bgi_log.parse_args(sys.argv[1:])
+    if not args:
         print('Usage: bgias.py <file(s)>')
-        print('(only .bsd files amongst <file(s)> will be processed)')
+        print('(only .bsd and .bsb files amongst <file(s)> will be processed)')
+        print(bgi_log.USAGE)
         sys.exit(1)
-    for sysarg in sys.argv[1:]:
+    scripts = []
+    for sysarg in args:
         for script in glob.glob(sysarg):
             base, ext = os.path.splitext(script)
-            if ext == '.bsd':
-                # print('Assembling %s...' % script)
-                asm(script)
+            if ext in ('.bsd', '.bsb'):
+                scripts.append(script)
             else:
-                print('skipping: {} (not .bsd)'.format(script), file=sys.stderr)
+                bgi_log.get_logger('as').warning('skipping: %s (not .bsd nor .bsb)', script)
+    for script in select_inputs(scripts):
+        # print('Assembling %s...' % script)
+        asm(script)
@@ -11,6 +11,9 @@ import buriko_common
 import buriko_setup
 
 import asdis
+import bgi_cache
+import bgi_log
+import bgi_script
 import bgiop
 
 
@@ -33,43 +36,56 @@ def parse_hdr(hdr):
     return hdrtext, defines
 
 
-def parse(code, hdr):
+def parse(code, hdr, instrs=None):
     """
     Parse the code section, with an optional header (0-length bytes otherwise)
-    Returns: tuple(dict, dict, bytes, dict)
+    `instrs` may hold the already decoded instruction stream of `code` (see bgiop.decode)
+    Returns: tuple(bgiop.Instructions, set, bytes, dict)
     """
     if hdr:
         hdrtext, defines = parse_hdr(hdr)
     else:
         hdrtext = None
         defines = {}
-    bgiop.clear_offsets()
-    inst = {}
-    size = buriko_common.get_section_boundary(code)
-    pos = 0
+    if instrs is None:
+        try:
+            instrs = bgiop.decode(code)
+        except asdis.InvalidBytecode:
+            instrs = bgiop.decode(code, buriko_common.get_section_boundary(code))
+    offset_ops = bgiop.offset_ops
+    offsets = {arg for opcode, arg in zip(instrs.opcodes, instrs.args) if opcode in offset_ops}
+    return instrs, offsets, hdrtext, defines
+
+
+def format_instrs(inst, defines):
+    """
+    Format each decoded instruction as text
+    Yields: tuple (addr:int, str)
+    """
     idx = 1
-    while pos < size:
-        addr = pos
-        opcode, = struct.unpack('<I', code[addr:addr + 4])
-        if opcode not in bgiop.ops:
-            raise Exception('size unknown for op %02x @ offset %05x' % (opcode, addr))
-        pos += 4
-        fmt, pfmt, fcn = bgiop.ops[opcode]
+    code = inst.code
+    if isinstance(code, memoryview):
+        code = bytes(code)  # strings are read with bytes.find(), see read_cstring()
+    ops = bgiop.ops
+    get_string = bgiop.get_string
+    get_file = bgiop.get_file
+    files = {}  # offset: file name, shared by all the line() of a file
+    for addr, opcode, args in inst:
+        fmt, pfmt, fcn = ops[opcode]
         if fmt:
-            oplen = struct.calcsize(fmt)
-            args = struct.unpack(fmt, code[pos:pos + oplen])
-            if fcn:
+            if fcn is get_file:
+                name = files.get(args[0])
+                if name is None:
+                    name = files[args[0]] = get_file(code, addr, defines, *args)[0]
+                args = (name, args[1])
+            elif fcn:
                 args = fcn(code, addr, defines, *args)
-                if fcn == bgiop.get_string:
-                    args = list(args)
-                    args.append(idx)
+                if fcn is get_string:
+                    args += (idx,)
                     idx = idx + 1
-            inst[addr] = pfmt.format(*args)
-            pos += oplen
+            yield addr, pfmt.format(*args)
         else:
-            inst[addr] = pfmt
-    offsets = bgiop.offsets.copy()
-    return inst, offsets, hdrtext, defines
+            yield addr, pfmt
 
 
 def out(disasmoutfile, inst, offsets, hdrtext, defines):
@@ -82,48 +98,56 @@ def out(disasmoutfile, inst, offsets, hdrtext, defines):
         for offset in sorted(defines):
             disasmoutfile.write('#define %s L%05x\n' % (defines[offset], offset))
         disasmoutfile.write('\n')
-    for addr in sorted(inst):
-        if inst[addr].startswith('line('):
-            disasmoutfile.write('\n')
-        if addr in offsets or addr in defines:
-            if addr in defines:
-                disasmoutfile.write('\n%s:\n' % defines[addr])
-            else:
-                disasmoutfile.write('\nL%05x:\n' % addr)
-        disasmoutfile.write('\t%s;\n' % inst[addr])
+    labels = {addr: '\nL%05x:\n' % addr for addr in offsets}
+    labels.update((addr, '\n%s:\n' % name) for addr, name in defines.items())
+    write = disasmoutfile.write
+    for addr, text in format_instrs(inst, defines):
+        if text.startswith('line('):
+            write('\n')
+        if addr in labels:
+            write(labels[addr])
+        write('\t' + text + ';\n')
 
 
-def dis(scriptpath):
+def dis(scriptpath, data=None):
     """
     Disassemble a file and write output to a .bsd file
+    (or a .bsb file with buriko_setup.intermediate = 'bsb', see bgi_bsb)
+    `data` may hold the script contents as any bytes-like object (e.g. an archive member),
+    `scriptpath` then only names the output
+    Emits a 'dis' event
     """
     buriko_common.makedir(buriko_setup.project_name)  # output folder for all files
     scriptname = os.path.basename(scriptpath)
-    ofilepath = os.path.join(buriko_setup.project_name, os.path.splitext(scriptname)[0] + '.bsd')
+    binary = buriko_setup.intermediate == 'bsb'
+    ofilepath = os.path.join(buriko_setup.project_name, os.path.splitext(scriptname)[0] +
+                             ('.bsb' if binary else '.bsd'))
 
-    infile = open(scriptpath, 'rb')
-    hdr_test = infile.read(0x20)
-    if hdr_test.startswith(b'BurikoCompiledScriptVer1.00\x00'):
-        hdrsize = 0x1C + struct.unpack('<I', hdr_test[0x1C:0x20])[0]
-    else:
-        hdrsize = 0
-    infile.seek(0, 0)
-    hdr = infile.read(hdrsize)
-    code = infile.read()
-    infile.close()
-
-    inst, offsets, hdrtext, defines = parse(code, hdr)
-
-    with open(ofilepath, 'w', encoding='utf-8-sig') as disasmfile:
-        out(disasmfile, inst, offsets, hdrtext, defines)
+    with bgi_log.timed('dis', file=scriptpath) as event:
+        if data is None:
+            with open(scriptpath, 'rb') as infile:
+                data = infile.read()
+        event['bytes'] = len(data)
+        script = bgi_script.Script(data, bgi_cache.get_default())
+        if binary:
+            with open(ofilepath, 'wb') as disasmfile:
+                disasmfile.write(script.disassemble_binary())
+            event['cached'] = 'bsb' in script.cached
+        else:
+            bsd = script.disassemble()
+            with open(ofilepath, 'w', encoding='utf-8-sig') as disasmfile:
+                disasmfile.write(bsd)
+            event['cached'] = 'dis' in script.cached
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    args = bgi_log.parse_args(sys.argv[1:])
+    if not args:
         print('Usage: bgidis.py <file(s)>')
         print('(only extension-less files amongst <file(s)> will be processed)')
+        print(bgi_log.USAGE)
         sys.exit(1)
-    for arg in sys.argv[1:]:
+    for arg in args:
         for script in glob.glob(arg):
             base, ext = os.path.splitext(script)
             if not ext and os.path.isfile(script):
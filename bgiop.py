@@ -3,10 +3,17 @@ Defines BGI script bytecode operations.
 
 Besides functions, exports
   bgiop.ops and bgiop.rops dictionaries
-  bgiop.offsets
+  bgiop.structs dictionary (precompiled argument formats)
+  bgiop.sizes dictionary (instruction sizes, opcode included)
+  bgiop.arg_sizes and bgiop.arg_kinds lists (argument size and ARG_* kind, indexed by opcode)
+  bgiop.text_ops set (ops referencing the text section)
+  bgiop.offset_ops set (ops referencing a code address)
 """
 
+import array
 import re
+import struct
+import sys
 
 import buriko_common
 import buriko_setup
@@ -15,25 +22,24 @@ import asdis
 
 re_fcn = re.compile(r'([A-Za-z_][A-Za-z0-9_:]*)\(.*\)')
 
-offsets = set()
+line_struct = struct.Struct('<i')
 
-
-def clear_offsets():
-    offsets.clear()
+# how Instructions rebuilds the arguments of an op from its `args` column
+ARG_NONE = 0      # no argument
+ARG_UNSIGNED = 1  # a single unsigned dword, stored as-is
+ARG_SIGNED = 2    # a single signed dword
+ARG_LINE = 3      # line(): unsigned dword then signed dword
 
 
 def get_string(code, addr, defines, *args):
-    pos0 = args[0]
-    pos1 = code.find(b'\x00', pos0)
-    string = buriko_common.get_escaped_text(code[pos0:pos1]).decode(buriko_setup.senc)
+    string = buriko_common.read_cstring(code, args[0])
+    string = buriko_common.get_escaped_text(string).decode(buriko_setup.senc)
     string = asdis.escape(string)
     return (string,)
 
 
 def get_file(code, addr, defines, *args):
-    pos0 = args[0]
-    pos1 = code.find(b'\x00', pos0)
-    string = code[pos0:pos1].decode(buriko_setup.senc)
+    string = buriko_common.read_cstring(code, args[0]).decode(buriko_setup.senc)
     string = asdis.escape(string)
     lno = args[1]
     return (string, lno)
@@ -41,7 +47,6 @@ def get_file(code, addr, defines, *args):
 
 def get_offset(code, addr, defines, *args):
     offset = args[0]
-    offsets.add(offset)
     if offset in defines:
         offset_s = defines[offset]
     else:
@@ -122,5 +127,137 @@ def _make_rops():
         rops[fcn] = op
 
 
+def _make_structs():
+    """
+    (Internal) Precompiles the argument format of each op in `ops` into `structs`,
+    records the size of its instructions in `sizes`,
+    lists in `text_ops` the ops whose first argument is an offset in the text section,
+    and in `offset_ops` those whose first argument is an address in the code section
+    `arg_sizes` and `arg_kinds` hold the same information as lists, for the decoding loops
+    """
+    kinds = {'': ARG_NONE, '<I': ARG_UNSIGNED, '<i': ARG_SIGNED, '<Ii': ARG_LINE}
+    arg_sizes.extend([0] * (max(ops) + 1))
+    arg_kinds.extend([ARG_NONE] * (max(ops) + 1))
+    for op in ops:
+        if ops[op][0]:
+            structs[op] = struct.Struct(ops[op][0])
+        sizes[op] = struct.calcsize(ops[op][0]) + 4
+        arg_sizes[op] = sizes[op] - 4
+        arg_kinds[op] = kinds[ops[op][0]]
+        if ops[op][2] is get_offset:
+            offset_ops.add(op)
+        if ops[op][2] in (get_string, get_file):
+            text_ops.add(op)
+
+
+class Instructions:
+    """
+    Decoded instruction stream, stored as parallel columns:
+      addrs: address of each instruction
+      opcodes: opcode of each instruction
+      args: raw first argument of each instruction (0 if it has none)
+      size: end offset of the instruction stream
+    Iterating yields tuple (addr:int, opcode:int, args:tuple), arguments being
+    unpacked on demand from the underlying `code` buffer.
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.size = 0
+        self.addrs = array.array('I')
+        self.opcodes = array.array('I')
+        self.args = array.array('I')
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __iter__(self):
+        code = self.code
+        kinds = arg_kinds
+        unpack_line = line_struct.unpack_from
+        for addr, opcode, arg in zip(self.addrs, self.opcodes, self.args):
+            kind = kinds[opcode]
+            if kind == ARG_NONE:
+                yield addr, opcode, ()
+            elif kind == ARG_UNSIGNED:
+                yield addr, opcode, (arg,)
+            elif kind == ARG_SIGNED:
+                yield addr, opcode, (arg - 0x100000000 if arg > 0x7FFFFFFF else arg,)
+            else:
+                yield addr, opcode, (arg,) + unpack_line(code, addr + 8)
+
+
+def get_dwords(view):
+    """
+    View the whole little-endian dwords of a byte buffer as unsigned integers
+    (zero-copy on little-endian hosts)
+    Returns: memoryview or array of int
+    """
+    view = view[:len(view) & ~3]
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    words = array.array('I', bytes(view))
+    words.byteswap()
+    return words
+
+
+def decode(code, size=None):
+    """
+    Decode the instruction stream at the beginning of `code`, up to offset `size`
+    `code` is the code section, optionally followed by the text section
+    Without `size`, the stream is decoded up to the first string referenced by the
+    instructions decoded so far: this is where the text section begins.
+    Returns: Instructions
+    """
+    instrs = Instructions(code)
+    view = memoryview(code)
+    words = get_dwords(view)
+    nbytes = len(words) * 4
+    add_addr = instrs.addrs.append
+    add_opcode = instrs.opcodes.append
+    add_arg = instrs.args.append
+    op_arg_sizes = arg_sizes
+    find_end = size is None
+    if find_end:
+        size = len(view)
+    pos = 0
+    opcode = None
+    try:
+        while pos < size:
+            opcode = words[pos >> 2]
+            argsize = op_arg_sizes[opcode]
+            add_addr(pos)
+            add_opcode(opcode)
+            pos += 4
+            if argsize:
+                arg = words[pos >> 2]
+                add_arg(arg)
+                pos += argsize
+                if find_end and arg < size and opcode in text_ops:
+                    size = arg
+            else:
+                add_arg(0)
+    except IndexError:
+        if pos + 4 <= nbytes:
+            raise asdis.UnknownOpcode('size unknown for op %02x @ offset %05x' % (opcode, pos))
+        raise asdis.InvalidBytecode('truncated instruction at the end of %05x bytes' % len(view))
+    finally:
+        if isinstance(words, memoryview):
+            words.release()
+    if find_end and pos != size:
+        raise asdis.InvalidBytecode('instruction @ offset %05x overlaps the text section at %05x'
+                                    % (instrs.addrs[-1], size))
+    instrs.size = pos
+    return instrs
+
+
+structs = {}
+sizes = {}
+arg_sizes = []
+arg_kinds = []
+text_ops = set()
+offset_ops = set()
+
 _make_ops()
 _make_rops()
+_make_structs()
@@ -2,9 +2,13 @@
 Common routines for handling Buriko scripts
 """
 
+import hashlib
+import marshal
 import os
 import errno
+import re
 import struct
+import tempfile
 
 import buriko_setup
 
@@ -43,46 +47,137 @@ def escape_private_sequence(data):
     return '&#{:04X}'.format(value).encode("ASCII")  # len() of this string must be an even number
 
 
+def read_cstring(data, offset):
+    """
+    Read a NUL-terminated string at `offset` of a bytes-like object (bytes, memoryview, mmap)
+    Returns: bytes, without the terminator
+    """
+    if isinstance(data, memoryview):  # no find() method
+        return re_cstring.match(data, offset).group()
+    end = data.find(b'\x00', offset)
+    return bytes(data[offset:end if end >= 0 else len(data)])
+
+
+def escape_private_sequences(text):
+    """
+    Escape all 0xFF.. sequences of a bytes string, in a single pass
+    0xFF is never a trail byte in cp932, so each one starts a sequence.
+    Returns: bytes
+    """
+    if b'\xFF' not in text:
+        return text
+    return re_private_sequence.sub(_escape_private_match, text)
+
+
 def get_escaped_text(text):
     """
     Escape all 0xFF.. sequences
     Returns: bytes
     """
     if buriko_setup.is_jis_source():
-        while (text.find(b'\xFF') % 2) == 0:
-            pvofs = text.find(b'\xFF')
-            text = text[:pvofs] + \
-                escape_private_sequence(text[pvofs:pvofs + 2]) + \
-                text[pvofs + 2:]
+        text = escape_private_sequences(text)
     return text
 
 
 def unescape_private_sequence(value):
     """
     `value` must be a bytes representation in target encoding bgi_setup.ienc
+    Reverse operation of escape_private_sequences(), in a single pass
+    Returns: bytes
+    """
+    if b'&#' not in value:
+        return value
+    return re_escaped_sequence.sub(_unescape_private_match, value)
+
+
+def encode_text(text):
+    """
+    Encode a string for the text section
+    Returns: bytes
+    """
+    return unescape_private_sequence(text.encode(buriko_setup.ienc))
+
+
+def get_digest(data):
+    """
+    Content hash of any bytes-like object (build manifests, decode cache keys)
+    Returns: str
     """
-    while True:
-        seqofs = value.find(b"&#")
-        if seqofs == -1:
-            break
-        hexval = value[seqofs + 2: seqofs + 6].decode('ASCII')
-        value = value[:seqofs] + bytes(bytearray.fromhex(hexval)) + value[seqofs + 6:]
-    return value
+    return hashlib.sha256(data).hexdigest()
+
+
+def load_build_file(path):
+    """
+    Load a marshal'd build manifest or cache file, ignoring missing or corrupted ones
+    Returns: object, or None
+    """
+    try:
+        with open(path, 'rb') as infile:
+            return marshal.load(infile)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def save_build_file(path, value):
+    """
+    Atomically write a marshal'd build manifest or cache file
+    The temporary file is unique to each call, so that concurrent writers of the same
+    path (e.g. bgi_batch workers) never replace it with a partial file.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            marshal.dump(value, outfile)
+        os.replace(tmppath, path)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+def _escape_private_match(match):
+    return _escaped_sequences[match.group()]
+
+
+def _unescape_private_match(match):
+    return bytes.fromhex(match.group(1).decode('ASCII'))
+
+
+re_cstring = re.compile(b'[^\x00]*')
+re_private_sequence = re.compile(b'\xFF[\x00-\xFF]')
+re_escaped_sequence = re.compile(b'&#([0-9A-Fa-f]{4})')
+_escaped_sequences = {bytes((0xFF, low)): escape_private_sequence(bytes((0xFF, low)))
+                      for low in range(0x100)}
+
+RETURN_OP = b'\x1B\x00\x00\x00'
+REVERSE_SCAN_CHUNK = 0x10000
 
 
 def get_section_boundary(data):
     """
-    Scans a BGI script buffer for the boundary before the text section
+    Scans a BGI script buffer backwards for the boundary before the text section
     ---
     This is somewhat of a kludge to get the beginning of the text section as it assumes
     that the code section ends with the byte sequence: 1B 00 00 00
     (this is probably a return or exit command).
+    The sequence may as well end a string, or be followed by more code, so this is only
+    a fallback for bytecode that bgiop.decode() cannot find the end of.
+    `data` may be any bytes-like object (bytes, memoryview, mmap)
     Returns: integer offset of boundary, or -1
     """
-    pos = -1
-    while 1:
-        res = data.find(b'\x1B\x00\x00\x00', pos + 1)
-        if res == -1:
-            break
-        pos = res
-    return pos + 4
+    if hasattr(data, 'rfind'):
+        pos = data.rfind(RETURN_OP)
+    else:
+        pos = -1
+        end = len(data)
+        while end > 0 and pos < 0:
+            start = max(0, end - REVERSE_SCAN_CHUNK)
+            # overlap the next chunk in case the sequence straddles both
+            pos = bytes(data[start:end + len(RETURN_OP) - 1]).rfind(RETURN_OP)
+            if pos >= 0:
+                pos += start
+            end = start
+    return pos + len(RETURN_OP) if pos >= 0 else -1
@@ -14,6 +14,24 @@ ilang = 'en'
 # Insertion encoding
 ienc = 'CP932'
 
+# Write each distinct string once in the text section, in order of first use, every
+# reference pointing to it (False writes a copy per reference, for byte-exact reproduction
+# of the output of previous versions). Like the original compiler, this stores each string
+# once, but the original files order their strings differently, so neither setting
+# reproduces them byte for byte.
+pool_strings = True
+
+# Intermediate written by bgidis for bgias: 'bsd' (text, editable) or 'bsb' (binary,
+# assembled without parsing, see bgi_bsb.py to convert between both)
+intermediate = 'bsd'
+
+# Skip assembling scripts whose .bsd, .po, settings and tools did not change since the last build
+incremental = True
+
+# Size limit in bytes of the cache of disassembly and dump results of unchanged scripts
+# (kept in the project folder, 0 disables it)
+decode_cache_size = 256 * 1024 * 1024
+
 # Do not modify below code
 def is_jis_source():
     return re.search(r'jis|932', senc, re.IGNORECASE) is not None
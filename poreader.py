@@ -1,4 +1,4 @@
-import polib
+import bgi_po
 import glob
 import sys
 import os.path
@@ -11,7 +11,7 @@ class Reader():
 
         for file in glob.glob(exp):
             print('reading %s' % file)
-            entries = polib.pofile(file)
+            entries = bgi_po.load_catalog(file)
 
             if entries != None:
                 print('found %d entries in %s' % (len(entries), file))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Checks that bgi_arc never writes outside the folder of the archive being processed
+
+Usage:
+  python -m unittest test_bgi_arc
+"""
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import bgi_arc
+import bgi_common
+
+
+def write_arc(path, members):
+    """
+    Write a "PackFile    " archive holding `members` (list of (binary name, bytes))
+    """
+    index = b''
+    data = b''
+    for name, contents in members:
+        index += name.ljust(0x10, b'\x00') + struct.pack('<II', len(data), len(contents))
+        index += b'\x00' * 8
+        data += contents
+    with open(path, 'wb') as outfile:
+        outfile.write(b'PackFile    ' + struct.pack('<I', len(members)) + index + data)
+
+
+class TestUnsafeNames(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        os.mkdir(self.outdir)
+        self.arcpath = os.path.join(self.outdir, 'data.arc')
+        inputdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input_aiyoku')
+        with open(os.path.join(inputdir, 'aiy00010'), 'rb') as infile:
+            self.script = infile.read()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def check_rejected(self, stage):
+        write_arc(self.arcpath, [(b'../evil', self.script)])
+        with self.assertRaises(bgi_common.BgiCustomException):
+            bgi_arc.process(stage, self.arcpath)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['out'])
+
+    def test_dump(self):
+        self.check_rejected('dump')
+
+    def test_dis(self):
+        self.check_rejected('dis')
+
+    def test_extract(self):
+        write_arc(self.arcpath, [(b'../evil', self.script)])
+        with self.assertRaises(bgi_common.BgiCustomException):
+            bgi_arc.extract(self.arcpath, self.outdir)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['out'])
+
+    def test_undecodable_name_closes_archive(self):
+        write_arc(self.arcpath, [(b'\x81\xff', b'')])
+        opened = []
+        init = bgi_arc.ArcFile.__init__
+
+        def record_init(arc, path):
+            opened.append(arc)
+            init(arc, path)
+
+        with mock.patch.object(bgi_arc.ArcFile, '__init__', record_init):
+            with self.assertRaises(bgi_common.BgiCustomException):
+                bgi_arc.ArcFile(self.arcpath)
+        arc, = opened
+        self.assertTrue(arc._file.closed)  # pylint: disable=protected-access
+        self.assertTrue(arc._map.closed)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+    unittest.main()